@@ -1,19 +1,122 @@
+import asyncio
 import base64
 import hmac
+import re
 import time
 import urllib.request as urllib
 from hashlib import sha1
+from typing import AsyncIterable, Dict, Iterable, List, Optional, Tuple, Union
 
-from aiohttp import ClientSession
+from aiofile import async_open
+from aiohttp import ClientError, ClientSession
 
-from .log import app_logger as logger
-from .web import RemoteServerError
+from .exception import RemoteServerError
+from .log import logger_error as logger
+from .utils import LRUCache, client_session
 
 chunk_size = 1024
 region_host = "oss-cn-hangzhou-internal.aliyuncs.com"
 
+# multipart upload defaults, oss requires every part except the last one >= 100KB
+part_size = 8 * 1024 * 1024
+part_concurrency = 4
+part_retries = 3
 
-def sign(method: str, app_id: str, app_secret: str, bucket: str, filename: str, content_type: str, expire: int = 3600) -> str:
+# expire is aligned to this window, signed urls are the same inside a window
+sign_window = 1800
+# signed urls cached by every Signer
+sign_cache_size = 4096
+
+
+class Signer(object):
+    """oss url signer of one app_id
+
+    the secret is encoded once into a hmac base which is copied for every signature,
+    urls without sub-resources are memoized by (method, bucket, filename, content_type, expire)
+    until the expire window moves
+    """
+
+    def __init__(self, app_id: str, app_secret: str, cache_size: int = None):
+        self.app_id = app_id
+        self.hmac = hmac.new(app_secret.encode(), digestmod=sha1)
+
+        self.window = 0
+        self.cache = LRUCache(sign_cache_size if cache_size is None else cache_size)
+
+    def sign(
+        self,
+        method: str,
+        bucket: str,
+        filename: str,
+        content_type: str = "",
+        expire: int = 3600,
+        params: Optional[Dict[str, Optional[str]]] = None,
+    ) -> str:
+        now = int(time.time())
+        window = now - (now % sign_window)  # expire will not different every second
+        if window != self.window:
+            self.cache.clear()
+            self.window = window
+
+        if params:
+            return self._sign(method, bucket, filename, content_type, window + expire, params)
+
+        key = (method, bucket, filename, content_type, expire)
+        url = self.cache.get(key)
+        if url is None:
+            url = self._sign(method, bucket, filename, content_type, window + expire, None)
+            self.cache.put(key, url)
+
+        return url
+
+    def url(self, bucket: str, filename: str, expire: int = 600) -> str:
+        return self.sign("GET", bucket, filename, expire=expire)
+
+    def urls(self, bucket: str, filenames: Iterable[str], expire: int = 600) -> List[str]:
+        """signed download urls of many files, for listing responses"""
+        return [self.sign("GET", bucket, i, expire=expire) for i in filenames]
+
+    def _sign(self, method: str, bucket: str, filename: str, content_type: str, expire: int, params) -> str:
+        resource = "/%s/%s" % (bucket, filename)
+        query = ""
+        if params:
+            items = sorted(params.items())
+            resource += "?" + "&".join(k if v is None else "%s=%s" % (k, v) for k, v in items)
+            query = "&".join(k if v is None else "%s=%s" % (k, urllib.quote(str(v), safe="")) for k, v in items) + "&"
+
+        tosign = "%s\n\n\n%d\n%s" % (method, expire, resource)
+        if method == "PUT" or method == "POST":
+            tosign = "%s\n\n%s\n%d\n%s" % (method, content_type, expire, resource)
+
+        h = self.hmac.copy()
+        h.update(tosign.encode())
+        sign = urllib.quote(base64.b64encode(h.digest()))
+
+        return "http://%s.%s/%s?%sOSSAccessKeyId=%s&Expires=%d&Signature=%s" % (bucket, region_host, filename, query, self.app_id, expire, sign)
+
+
+# (app_id, app_secret) -> Signer
+_signers: Dict[Tuple[str, str], Signer] = {}
+
+
+def get_signer(app_id: str, app_secret: str) -> Signer:
+    """shared Signer of app_id"""
+    signer = _signers.get((app_id, app_secret))
+    if signer is None:
+        signer = _signers[(app_id, app_secret)] = Signer(app_id, app_secret)
+    return signer
+
+
+def sign(
+    method: str,
+    app_id: str,
+    app_secret: str,
+    bucket: str,
+    filename: str,
+    content_type: str = "",
+    expire: int = 3600,
+    params: Optional[Dict[str, Optional[str]]] = None,
+) -> str:
     """sign a oss object url
 
     params:
@@ -24,16 +127,9 @@ def sign(method: str, app_id: str, app_secret: str, bucket: str, filename: str,
     - filename: full file path
     - content_type: file mimetype
     - expire: expire after current timestamp(uint: second)
+    - params: oss sub-resources like uploads/partNumber/uploadId, they are signed and added to the query
     """
-    now = int(time.time())
-    expire = now - (now % 1800) + expire  # expire will not different every second
-    tosign = "%s\n\n\n%d\n/%s/%s" % (method, expire, bucket, filename)
-    if method == "PUT" or method == "POST":
-        tosign = "%s\n\n%s\n%d\n/%s/%s" % (method, content_type, expire, bucket, filename)
-    h = hmac.new(app_secret.encode(), tosign.encode(), sha1)
-    sign = urllib.quote(base64.encodestring(h.digest()).strip())
-
-    return "http://%s.%s/%s?OSSAccessKeyId=%s&Expires=%d&Signature=%s" % (bucket, region_host, filename, app_id, expire, sign)
+    return get_signer(app_id, app_secret).sign(method, bucket, filename, content_type, expire, params)
 
 
 def url(app_id: str, app_secret: str, bucket: str, filename: str, expire=600):
@@ -50,7 +146,29 @@ def url(app_id: str, app_secret: str, bucket: str, filename: str, expire=600):
     return sign("GET", app_id, app_secret, bucket, filename, expire=expire)
 
 
-async def put(app_id: str, app_secret: str, bucket: str, filename: str, data: bytes, content_type: str):
+def urls(app_id: str, app_secret: str, bucket: str, filenames: Iterable[str], expire=600) -> List[str]:
+    """get oss object urls of many files
+
+    params:
+
+    - app_id: application id
+    - app_secret: secret
+    - bucket: bucket name
+    - filenames: full file paths
+    - expire: expire after current timestamp(uint: second)
+    """
+    return get_signer(app_id, app_secret).urls(bucket, filenames, expire=expire)
+
+
+async def put(
+    app_id: str,
+    app_secret: str,
+    bucket: str,
+    filename: str,
+    data: bytes,
+    content_type: str,
+    session: Optional[ClientSession] = None,
+):
     """put file content to oss by bucket & filename
 
     params:
@@ -61,11 +179,160 @@ async def put(app_id: str, app_secret: str, bucket: str, filename: str, data: by
     - filename: full file path
     - data: file content bytes
     - content_type: file mimetype
+    - session: explicit http session, default is the shared utils.session
     """
     url = sign("PUT", app_id, app_secret, bucket, filename, content_type)
 
-    async with ClientSession(headers={"content-type": content_type}) as session:
-        async with session.put(url, data=data) as resp:
+    async with client_session(session) as s:
+        async with s.put(url, data=data, headers={"content-type": content_type}) as resp:
             if resp.status != 200:
-                logger.error("[aliyun.put_object]failed:%d %s", resp.status, resp.reason)
+                logger.error(f"[aliyun.put_object]failed:{resp.status} {resp.reason}")
                 raise RemoteServerError(resp.status, resp.reason)
+
+
+async def put_multipart(
+    app_id: str,
+    app_secret: str,
+    bucket: str,
+    filename: str,
+    source: Union[str, AsyncIterable[bytes]],
+    content_type: str,
+    size: int = None,
+    concurrency: int = None,
+    retries: int = None,
+    session: Optional[ClientSession] = None,
+) -> str:
+    """upload file or async byte stream to oss by multipart upload, return etag of the object
+
+    parts are uploaded concurrently, at most `concurrency` parts are held in memory,
+    every failed part is retried alone, the upload is aborted when a part still fails
+
+    params:
+
+    - app_id: application id
+    - app_secret: secret
+    - bucket: bucket name
+    - filename: full file path
+    - source: local file path or async iterator of bytes
+    - content_type: file mimetype
+    - size: part size, default aliyun.part_size
+    - concurrency: parts uploaded at the same time, default aliyun.part_concurrency
+    - retries: retry times of every part, default aliyun.part_retries
+    - session: explicit http session, default is the shared utils.session
+    """
+    size = size or part_size
+    concurrency = concurrency or part_concurrency
+    retries = part_retries if retries is None else retries
+
+    def _sign(method, content_type="", **params):
+        return sign(method, app_id, app_secret, bucket, filename, content_type, params=params)
+
+    async with client_session(session) as s:
+        # initiate
+        url = _sign("POST", content_type, uploads=None)
+        async with s.post(url, headers={"content-type": content_type}) as resp:
+            body = await resp.text()
+            if resp.status != 200:
+                logger.error(f"[aliyun.put_multipart]initiate failed:{resp.status} {resp.reason} {body}")
+                raise RemoteServerError(resp.status, resp.reason)
+
+        upload_id = _xml_value(body, "UploadId")
+
+        etags: Dict[int, str] = {}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def upload(number: int, data: bytes):
+            try:
+                for retry in range(retries + 1):
+                    url = _sign("PUT", "application/octet-stream", partNumber=number, uploadId=upload_id)
+                    try:
+                        async with s.put(url, data=data, headers={"content-type": "application/octet-stream"}) as resp:
+                            if resp.status == 200:
+                                etags[number] = resp.headers["ETag"]
+                                return
+
+                            error = RemoteServerError(resp.status, resp.reason)
+                    except (ClientError, asyncio.TimeoutError) as e:
+                        error = RemoteServerError(msg=str(e))
+
+                    logger.error(f"[aliyun.put_multipart]part {number} failed({retry}/{retries}):{error.code} {error.error}")
+                    if retry < retries:
+                        await asyncio.sleep(0.1 * 2**retry)
+
+                raise error
+            finally:
+                semaphore.release()
+
+        tasks = []
+        try:
+            number = 0
+            async for data in _iter_parts(source, size):
+                number += 1
+
+                # bound parts in memory
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(upload(number, data)))
+
+                # stop reading when a part already failed
+                for task in tasks:
+                    if task.done() and task.exception() is not None:
+                        raise task.exception()
+
+            # oss needs one part at least
+            if number == 0:
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(upload(1, b"")))
+
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            url = _sign("DELETE", uploadId=upload_id)
+            try:
+                async with s.delete(url) as resp:
+                    pass
+            except (ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"[aliyun.put_multipart]abort {upload_id} failed:{e}")
+            raise
+
+        # complete
+        parts = "".join(f"<Part><PartNumber>{i}</PartNumber><ETag>{etags[i]}</ETag></Part>" for i in sorted(etags))
+        url = _sign("POST", "application/xml", uploadId=upload_id)
+        data = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode()
+        async with s.post(url, data=data, headers={"content-type": "application/xml"}) as resp:
+            body = await resp.text()
+            if resp.status != 200:
+                logger.error(f"[aliyun.put_multipart]complete failed:{resp.status} {resp.reason} {body}")
+                raise RemoteServerError(resp.status, resp.reason)
+
+        return _xml_value(body, "ETag")
+
+
+async def _iter_parts(source: Union[str, AsyncIterable[bytes]], size: int):
+    """split file or async byte stream into parts of size bytes"""
+    if isinstance(source, str):
+        async with async_open(source, "rb") as f:
+            while True:
+                data = await f.read(size)
+                if not data:
+                    return
+                yield data
+
+    buffer = bytearray()
+    async for data in source:
+        buffer += data
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+
+    if buffer:
+        yield bytes(buffer)
+
+
+def _xml_value(body: str, tag: str) -> str:
+    m = re.search(f"<{tag}>(.*?)</{tag}>", body, re.S)
+    if m is None:
+        raise RemoteServerError(msg=f"{tag} not found in response")
+    return m.group(1)
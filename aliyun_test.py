@@ -0,0 +1,193 @@
+from . import aliyun
+from .exception import RemoteServerError
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import re
+import socket
+import tempfile
+import unittest
+import urllib.request as urllib
+from hashlib import sha1
+from unittest import mock
+
+from aiohttp import ClientSession, TCPConnector, web
+from aiohttp.abc import AbstractResolver
+from aiohttp.test_utils import TestServer
+
+
+class LocalResolver(AbstractResolver):
+    """resolve every bucket host to the local fake oss server"""
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [{"hostname": host, "host": "127.0.0.1", "port": port, "family": family, "proto": 0, "flags": 0}]
+
+    async def close(self):
+        pass
+
+
+class FakeOSS(object):
+    """multipart upload api of oss, keep objects in memory"""
+
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+        self.aborted = []
+        self.requests = []
+        self.fail = {}  # part number -> failure times
+
+        self.app = web.Application()
+        self.app.router.add_route("*", "/{filename:.*}", self.handle)
+
+    async def handle(self, request: web.Request):
+        self.requests.append((request.method, dict(request.query)))
+        self.assertSigned(request)
+
+        filename = request.match_info["filename"]
+        query = request.query
+
+        if request.method == "POST" and "uploads" in query:
+            upload_id = "upload-%d" % len(self.uploads)
+            self.uploads[upload_id] = {}
+            return web.Response(text=f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>")
+
+        parts = self.uploads[query["uploadId"]]
+
+        if request.method == "PUT":
+            number = int(query["partNumber"])
+            data = await request.read()
+
+            if self.fail.get(number):
+                self.fail[number] -= 1
+                return web.Response(status=500)
+
+            parts[number] = data
+            return web.Response(headers={"ETag": '"%s"' % hashlib.md5(data).hexdigest()})
+
+        if request.method == "DELETE":
+            self.aborted.append(query["uploadId"])
+            return web.Response(status=204)
+
+        body = await request.text()
+        numbers = [int(i) for i in re.findall(r"<PartNumber>(\d+)</PartNumber>", body)]
+        self.objects[filename] = b"".join(parts[i] for i in numbers)
+        return web.Response(text='<CompleteMultipartUploadResult><ETag>"done"</ETag></CompleteMultipartUploadResult>')
+
+    def assertSigned(self, request):
+        query = request.query
+        assert query["OSSAccessKeyId"] == "app"
+
+        resource = "/bucket/" + request.match_info["filename"]
+        sub = sorted((k, v) for k, v in query.items() if k in ["uploads", "partNumber", "uploadId"])
+        if sub:
+            resource += "?" + "&".join(f"{k}={v}" if v else k for k, v in sub)
+
+        content_type = request.headers.get("Content-Type", "") if request.method in ["PUT", "POST"] else ""
+        tosign = f"{request.method}\n\n{content_type}\n{query['Expires']}\n{resource}"
+        h = hmac.new(b"secret", tosign.encode(), sha1)
+        assert base64.b64encode(h.digest()).decode() == query["Signature"], tosign
+
+    async def __aenter__(self):
+        self.server = TestServer(self.app, host="127.0.0.1")
+        await self.server.start_server()
+        self.port = self.server.port
+        return self
+
+    async def __aexit__(self, *args):
+        await self.server.close()
+
+
+class TestMultipart(unittest.TestCase):
+    CONTENT = os.urandom(1000 * 1000 + 7)
+
+    def setUp(self):
+        self.region_host = aliyun.region_host
+
+    def tearDown(self):
+        aliyun.region_host = self.region_host
+
+    def upload(self, oss: FakeOSS, source, **kwargs):
+        async def run():
+            async with oss:
+                aliyun.region_host = "oss.test:%d" % oss.port
+
+                async with ClientSession(connector=TCPConnector(resolver=LocalResolver())) as session:
+                    src = source() if callable(source) else source
+                    return await aliyun.put_multipart(
+                        "app", "secret", "bucket", "dir/a.bin", src, "application/octet-stream", session=session, **kwargs
+                    )
+
+        return asyncio.run(run())
+
+    def test_file(self):
+        oss = FakeOSS()
+        oss.fail[2] = 1
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(self.CONTENT)
+            f.flush()
+
+            etag = self.upload(oss, f.name, size=100 * 1000, concurrency=3, retries=1)
+
+        self.assertEqual(etag, '"done"')
+        self.assertEqual(oss.objects["dir/a.bin"], self.CONTENT)
+        self.assertEqual(len(oss.uploads["upload-0"]), 11)
+        self.assertEqual(len([i for i in oss.requests if i[1].get("partNumber") == "2"]), 2)
+
+    def test_stream(self):
+        async def stream():
+            for i in range(0, len(self.CONTENT), 4096):
+                yield self.CONTENT[i : i + 4096]
+
+        oss = FakeOSS()
+        self.upload(oss, stream, size=256 * 1000)
+        self.assertEqual(oss.objects["dir/a.bin"], self.CONTENT)
+        self.assertEqual(sorted(oss.uploads["upload-0"]), [1, 2, 3, 4])
+
+    def test_abort(self):
+        oss = FakeOSS()
+        oss.fail[3] = 2
+
+        with self.assertRaises(RemoteServerError):
+            self.upload(oss, self.stream_of(self.CONTENT), size=100 * 1000, retries=1)
+
+        self.assertEqual(oss.aborted, ["upload-0"])
+        self.assertEqual(oss.objects, {})
+
+    @staticmethod
+    def stream_of(content):
+        async def stream():
+            yield content
+
+        return stream
+
+
+class TestSigner(unittest.TestCase):
+    def expected(self, method, filename, content_type, expires):
+        tosign = f"{method}\n\n{content_type}\n{expires}\n/bucket/{filename}"
+        h = hmac.new(b"secret", tosign.encode(), sha1)
+        signature = urllib.quote(base64.b64encode(h.digest()))
+        return f"http://bucket.{aliyun.region_host}/{filename}?OSSAccessKeyId=app&Expires={expires}&Signature={signature}"
+
+    def test_sign(self):
+        signer = aliyun.Signer("app", "secret")
+
+        with mock.patch.object(aliyun.time, "time", return_value=3600 * 100 + 10):
+            url = signer.url("bucket", "a.jpg")
+            self.assertEqual(url, self.expected("GET", "a.jpg", "", 3600 * 100 + 600))
+            self.assertEqual(signer.sign("PUT", "bucket", "a.jpg", "image/jpeg"), self.expected("PUT", "a.jpg", "image/jpeg", 3600 * 101))
+            self.assertEqual(aliyun.url("app", "secret", "bucket", "a.jpg"), url)
+
+            self.assertEqual(signer.urls("bucket", ["a.jpg", "b.jpg", "a.jpg"]), [url, self.expected("GET", "b.jpg", "", 3600 * 100 + 600), url])
+            self.assertEqual(signer.cache.hits, 2)
+
+        # same window
+        with mock.patch.object(aliyun.time, "time", return_value=3600 * 100 + 1799):
+            self.assertIs(signer.url("bucket", "a.jpg"), url)
+
+        # next window
+        with mock.patch.object(aliyun.time, "time", return_value=3600 * 100 + 1800):
+            self.assertEqual(signer.url("bucket", "a.jpg"), self.expected("GET", "a.jpg", "", 3600 * 100 + 1800 + 600))
+            self.assertEqual(len(signer.cache), 1)
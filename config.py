@@ -26,9 +26,53 @@ def load_config() -> ConfigParser:
             # http listen on
             "host": "127.0.0.1",
             "port": 8080,
+            # shared http client connector
+            "client_limit": 100,
+            "client_limit_per_host": 16,
+            "client_keepalive_timeout": 30,
+            "client_dns_cache_ttl": 300,
+            # per route latency histograms, served in prometheus text format on metrics_path,
+            # they are kept per process, so with prefork every scrape sees one worker only
+            "metrics": False,
+            "metrics_path": "/metrics",
+            # fork workers and supervise them, 0 workers means cpu count.
+            # a local ipgeo database is loaded before fork, download and refresh run once in a helper process
+            "prefork": False,
+            "workers": 0,
+            # every worker binds the port with SO_REUSEPORT, otherwise they accept on one socket of the master
+            "reuse_port": True,
+            # seconds for workers to finish requests on stop
+            "graceful_timeout": 30,
         }
 
-        config["database"] = {}
+        config["database"] = {
+            # postgresql = primary dsn
+            # comma separated replica dsn, reads of serial GetMethod/FindMethod go to them
+            "postgresql_replicas": "",
+            # round_robin or least_busy
+            "replica_select": "round_robin",
+            # every pool
+            "pool_min_size": 1,
+            "pool_max_size": 10,
+            # connections opened on startup by every process for every pool, 0 means off.
+            # keep processes * pools * it under max_connections of postgresql,
+            # the ones over pool_min_size are closed after max_inactive_connection_lifetime idle
+            "pool_warmup": 0,
+            "command_timeout": 5.0,
+            "connect_timeout": 10.0,
+            "max_inactive_connection_lifetime": 600,
+        }
+
+        config["ipgeo"] = {
+            # flat-array index, otherwise walk the xdb content
+            "compiled": True,
+            # walk a mmap of the database file, shared by worker processes in the page cache, compiled is ignored
+            "mapped": False,
+            # lru cache capacity of ipgeo.find, 0 means disabled
+            "cache_size": 0,
+            # download and swap in the database every N seconds, 0 means disabled
+            "refresh_interval": 0,
+        }
 
         if os.path.isfile(CONFIG_FILE):
             with open(CONFIG_FILE, "r") as fobj:
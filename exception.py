@@ -5,6 +5,9 @@ class ErrorBasic(Exception):
     code = 500
     error = "unknown error"
 
+    # json of the class code and error
+    payload: bytes
+
     def __init__(self, code=None, msg=None):
         if code is not None:
             self.code = code
@@ -15,13 +18,26 @@ class ErrorBasic(Exception):
         self.reason = self.error
         self.log_message = None
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # constant payload of the class, serialized once
+        cls.payload = json.dumps({"code": cls.code, "error": cls.error})
+
     def dump(self):
         return {"code": self.code, "error": self.error}
 
     def dumps(self):
+        cls = self.__class__
+        if cls.dump is ErrorBasic.dump and self.code == cls.code and self.error == cls.error:
+            return cls.payload
+
         return json.dumps(self.dump())
 
 
+ErrorBasic.payload = json.dumps({"code": ErrorBasic.code, "error": ErrorBasic.error})
+
+
 class ServerError(ErrorBasic):
     code = 500
     error = "server error"
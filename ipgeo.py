@@ -1,14 +1,27 @@
+import asyncio
+import hashlib
 import io
+import ipaddress
+import mmap
 import os
 import socket
 import struct
 import sys
-from typing import Optional
-from dataclasses import dataclass, field
+from array import array
+from bisect import bisect_right
+from types import MappingProxyType
+from typing import Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
+from dataclasses import dataclass
+from email.utils import formatdate
 from typing import Dict
 
 from .log import logger_debug as logger
-from .utils import download
+from .utils import LRUCache, download_to_path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 URLS_DB = [
     "https://github.com/lionsoul2014/ip2region/raw/master/data/ip2region.xdb",
@@ -17,13 +30,36 @@ URLS_DB = [
 
 PATH_DB = "data/ipgeo/ip2region.db"
 
-__all__ = ["load", "find"]
+# ipv6 segments in ip2region source format, start|end|country|area|province|city|isp per line
+PATH_DB_V6 = "data/ipgeo/ipv6_source.txt"
 
-db: Optional["XdbSearcher"] = None
+__all__ = ["load", "update", "refresh", "serve", "ready", "find", "find_many", "stats"]
 
+db: Optional[Union["XdbIndex", "XdbSearcher"]] = None
+db6: Optional["IPv6Index"] = None
 
-@dataclass
-class IPLocationInfo:
+# ip -> IPLocationInfo, replaced on every load
+cache: Optional[LRUCache] = None
+
+# addresses looked up by find and find_many
+lookups = {"find": 0, "find_many": 0}
+
+
+class IPRegion(NamedTuple):
+    """interned region record, 国家|区域|省份|城市|ISP，缺省的地域信息默认是0"""
+
+    country: str = ""
+    area: str = ""
+    province: str = ""
+    city: str = ""
+    isp: str = ""
+
+
+EMPTY_REGION = IPRegion()
+EMPTY_INFO: Mapping = MappingProxyType({})
+
+
+class IPLocationInfo(object):
     """
     ```python
     # 国家|区域|省份|城市|ISP，缺省的地域信息默认是0
@@ -37,15 +73,74 @@ class IPLocationInfo:
         "info": {},
     }
     ```
+
+    immutable, region fields are read from the interned IPRegion record shared by all lookups
+
+    not a dataclass anymore, use dump() instead of dataclasses.asdict,
+    and from_fields() for the old IPLocationInfo(ip, country, area, province, city, isp, info)
     """
 
+    __slots__ = ("ip", "region", "info")
+
     ip: str
-    country: str
-    area: str
-    province: str
-    city: str
-    isp: str
-    info: Dict = field(default_factory=dict)
+    region: IPRegion
+    info: Mapping
+
+    def __init__(self, ip: str, region: IPRegion = EMPTY_REGION, info: Optional[Mapping] = None):
+        object.__setattr__(self, "ip", ip)
+        object.__setattr__(self, "region", region)
+        object.__setattr__(self, "info", info or EMPTY_INFO)
+
+    @classmethod
+    def from_fields(
+        cls,
+        ip: str,
+        country: str = "",
+        area: str = "",
+        province: str = "",
+        city: str = "",
+        isp: str = "",
+        info: Optional[Mapping] = None,
+    ) -> "IPLocationInfo":
+        """same arguments as the old dataclass constructor"""
+        return cls(ip, IPRegion(country, area, province, city, isp), info)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    @property
+    def country(self) -> str:
+        return self.region.country
+
+    @property
+    def area(self) -> str:
+        return self.region.area
+
+    @property
+    def province(self) -> str:
+        return self.region.province
+
+    @property
+    def city(self) -> str:
+        return self.region.city
+
+    @property
+    def isp(self) -> str:
+        return self.region.isp
+
+    def dump(self):
+        return {"ip": self.ip, **self.region._asdict(), "info": dict(self.info)}
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.ip == other.ip and self.region == other.region and self.info == other.info
+
+    def __hash__(self):
+        return hash((self.ip, self.region))
 
     def __str__(self):
         return f"ip:{self.ip},country:{self.country},area:{self.area},province:{self.province},city:{self.city},isp:{self.isp},info:{self.info}"
@@ -54,20 +149,44 @@ class IPLocationInfo:
         return self.__str__()
 
 
-async def load():
-    """load database from PATH_DB"""
-    global db
+async def load(compiled: bool = True, mapped: bool = False, cache_size: int = 0, download: bool = True):
+    """load database from PATH_DB, and ipv6 segments from PATH_DB_V6 if exists
+
+    compiled: build a flat-array XdbIndex for lookups, otherwise walk the xdb content with XdbSearcher
+    mapped: walk a read-only memory map of PATH_DB with XdbSearcher, compiled is ignored.
+            the file is not read at startup and every worker process searches the same page cache copy
+    cache_size: capacity of the lru result cache in front of find, 0 means disabled
+    download: download a missing PATH_DB and remove a broken one,
+              otherwise only an existing file is read and the process downloading it owns it(e.g. prefork workers)
+    """
+    global db6
 
     if not os.path.isdir("data/ipgeo"):
         os.makedirs("data/ipgeo")
 
-    # use utils.download try to download content from URLS_DB
-    if not os.path.isfile(PATH_DB):
+    loop = asyncio.get_running_loop()
+
+    await _load_v4(loop, compiled, mapped, cache_size, download)
+
+    # optional, a broken source file does not stop ipv4 lookups
+    if os.path.isfile(PATH_DB_V6):
+        try:
+            db6 = await loop.run_in_executor(None, IPv6Index.load_from_file, PATH_DB_V6)
+            logger.info(f"load ipv6 location database from {PATH_DB_V6}, {db6}")
+        except (OSError, ValueError) as e:
+            logger.warning(f"load ipv6 location database from {PATH_DB_V6} failed:{e}")
+
+
+async def _load_v4(loop, compiled: bool, mapped: bool, cache_size: int, download: bool):
+    global _digest
+
+    # use utils.download_to_path try to stream content from URLS_DB, hashed while downloading
+    if download and not os.path.isfile(PATH_DB):
         for url in URLS_DB:
+            hasher = hashlib.sha256()
             try:
-                content = await download(url, timeout=30)
-                with open(PATH_DB, "wb+") as f:
-                    f.write(content)
+                await download_to_path(url, PATH_DB, timeout=30, digest=hasher)
+                _digest = hasher.hexdigest()
                 break
             except Exception as e:
                 logger.warning(f"download {url} failed:{e}")
@@ -76,49 +195,576 @@ async def load():
         logger.warning(f"{PATH_DB} not exist!")
         return
 
-    cb = XdbSearcher.loadContentFromFile(dbfile=PATH_DB)
-    db = XdbSearcher(contentBuff=cb)
+    # parse out of the event loop
+    try:
+        searcher = await loop.run_in_executor(None, _build, PATH_DB, compiled, mapped)
+    except ValueError as e:
+        if not download:
+            logger.warning(f"{PATH_DB} is broken:{e}")
+            return
+
+        # download again by next load or update
+        logger.warning(f"{PATH_DB} is broken, remove it:{e}")
+        os.remove(PATH_DB)
+        _digest = None
+        return
+
+    _swap(searcher, cache_size)
+
+    logger.info(f"load ip location database from {PATH_DB}, {db}")
+
+
+async def serve(refresh_interval: int = 0, compiled: bool = True, mapped: bool = False, cache_size: int = 0):
+    """load database then keep it updated every refresh_interval seconds, run as a background task
+
+    find returns empty result until ready()
+    """
+    try:
+        await load(compiled=compiled, mapped=mapped, cache_size=cache_size)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"load ip location database failed:{e}")
+
+    if refresh_interval > 0:
+        await refresh(refresh_interval, compiled=compiled, mapped=mapped, cache_size=cache_size)
+
+
+def ready() -> bool:
+    """ipv4 database is loaded and serving lookups"""
+    return db is not None
+
+
+async def update(compiled: bool = True, mapped: bool = False, cache_size: int = 0) -> bool:
+    """download the database again and swap it in when the content changed
+
+    conditional requests are used per mirror, the new searcher is built in a thread,
+    lookups keep using the old one until the swap, return True when the database is replaced
+    """
+    path = PATH_DB + ".download"
+
+    for url in URLS_DB:
+        headers = dict(_validators.get(url, {}))
+        if not headers and os.path.isfile(PATH_DB):
+            headers["If-Modified-Since"] = formatdate(os.path.getmtime(PATH_DB), usegmt=True)
+
+        hasher = hashlib.sha256()
+        try:
+            resp_headers = await download_to_path(url, path, headers=headers, timeout=60, digest=hasher)
+        except Exception as e:
+            logger.warning(f"download {url} failed:{e}")
+            continue
+
+        if resp_headers is None:
+            logger.debug(f"{url} not modified")
+            return False
+
+        break
+    else:
+        return False
+
+    loop = asyncio.get_running_loop()
+    searcher = await loop.run_in_executor(None, _prepare, path, hasher.hexdigest(), compiled, mapped)
+
+    # only a checked download is revalidated, a broken one is downloaded again
+    _validators[url] = {k: resp_headers[v] for k, v in _VALIDATORS.items() if v in resp_headers}
+
+    if searcher is None:
+        logger.debug(f"{PATH_DB} not changed")
+        return False
+
+    _swap(searcher, cache_size)
+
+    logger.info(f"reload ip location database from {PATH_DB}, {db}")
+    return True
+
+
+async def refresh(interval: int, compiled: bool = True, mapped: bool = False, cache_size: int = 0):
+    """update the database every interval seconds, run as a background task"""
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await update(compiled=compiled, mapped=mapped, cache_size=cache_size)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"refresh ip location database failed:{e}")
+
+
+# request header -> response header of conditional requests
+_VALIDATORS = {"If-None-Match": "ETag", "If-Modified-Since": "Last-Modified"}
+
+# url -> conditional request headers of the last download
+_validators: Dict[str, Dict[str, str]] = {}
+
+# sha256 of PATH_DB content
+_digest: Optional[str] = None
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 << 19), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _check(cb, path: str):
+    """reject truncated or non xdb content by the header, raise ValueError"""
+    if cb is None or len(cb) < HeaderInfoLength + VectorIndexRows * VectorIndexCols * VectorIndexSize:
+        raise ValueError(f"{path} is too small")
+
+    _, _, _, ptr_start, ptr_end = struct.unpack_from("<HHIII", cb, 0)
+    if not (ptr_start <= ptr_end and ptr_end + SegmentIndexSize <= len(cb)):
+        raise ValueError(f"{path} segment index {ptr_start}-{ptr_end} out of content size {len(cb)}")
+
+
+def _read_content(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _map_content(path: str) -> memoryview:
+    """read-only memory map of the whole xdb, slicing the returned memoryview is zero-copy, an empty file raise ValueError"""
+    with open(path, "rb") as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def _build(path: str, compiled: bool, mapped: bool) -> Union["XdbIndex", "XdbSearcher"]:
+    """build searcher from xdb file, raise ValueError when the content is broken, OSError when it can not be read
+
+    a mapped file is always walked, compiling would read all of it into a private index of the process
+    """
+    if mapped:
+        cb = _map_content(path)
+        _check(cb, path)
+        return XdbSearcher(contentBuff=cb)
+
+    cb = _read_content(path)
+    _check(cb, path)
+
+    if compiled:
+        return XdbIndex(contentBuff=cb)
+
+    return XdbSearcher(contentBuff=cb)
+
+
+def _prepare(path: str, digest: str, compiled: bool, mapped: bool) -> Optional[Union["XdbIndex", "XdbSearcher"]]:
+    """compare downloaded file digest with PATH_DB, build searcher and move it to PATH_DB when changed, run in thread"""
+    global _digest
+
+    if _digest is None and os.path.isfile(PATH_DB):
+        _digest = _file_digest(PATH_DB)
+
+    if digest == _digest:
+        os.remove(path)
+        return None
+
+    try:
+        searcher = _build(path, compiled, mapped)
+    except ValueError:
+        os.remove(path)
+        raise
+
+    # a memory map keeps the replaced inode alive
+    os.replace(path, PATH_DB)
+    _digest = digest
+
+    return searcher
+
+
+def _swap(searcher: Union["XdbIndex", "XdbSearcher"], cache_size: int):
+    """replace database then cache, find reads cache before db, so a new cache never holds old results"""
+    global db, cache
+
+    db = searcher
+    # drop results of the previous database
+    cache = LRUCache(cache_size) if cache_size > 0 else None
+
+
+# region string -> interned record, for the xdb walker which returns raw strings
+_regions: Dict[str, IPRegion] = {}
+
+
+def _parse_region(region: str) -> IPRegion:
+    """split region string into IPRegion, 0 means empty"""
+    if not region:
+        return EMPTY_REGION
+
+    # 国家|区域|省份|城市|ISP，缺省的地域信息默认是0
+    params = [i if i != "0" else "" for i in region.split("|")]
+    return IPRegion(*params[:5])
+
+
+def _intern_region(region: str) -> IPRegion:
+    record = _regions.get(region)
+    if record is None:
+        record = _regions[region] = _parse_region(region)
+    return record
+
+
+def _unmap(ip: str) -> Optional[str]:
+    """ipv4 address of an ipv4-mapped ipv6 address(::ffff:8.8.8.8), None for others"""
+    try:
+        mapped = ipaddress.IPv6Address(ip).ipv4_mapped
+    except ValueError:
+        return None
+
+    return str(mapped) if mapped is not None else None
+
+
+def _lookup(searcher, searcher6, ip) -> IPRegion:
+    # dispatch by address family, ipv4-mapped addresses are searched in the ipv4 database
+    if ":" in ip:
+        v4 = _unmap(ip)
+        if v4 is None:
+            return searcher6.lookup(ip) if searcher6 is not None else EMPTY_REGION
+        ip = v4
+
+    if searcher is None:
+        return EMPTY_REGION
+
+    if isinstance(searcher, XdbIndex):
+        return searcher.lookup(ip)
 
-    logger.info(f"load ip location database from {PATH_DB}")
+    return _intern_region(searcher.search(ip))
 
 
 def find(ip) -> IPLocationInfo:
-    global db
-
-    if db is None:
-        return IPLocationInfo(
-            ip=ip,
-            country="",
-            area="",
-            province="",
-            city="",
-            isp="",
-            info={},
-        )
-
-    params = ["", "", "", "", "", ""]
+    lookups["find"] += 1
+
+    # keep references, the database may be swapped while searching
+    c = cache
+    searcher = db
+    searcher6 = db6
+
+    if searcher is None and searcher6 is None:
+        return IPLocationInfo(ip)
+
+    if c is not None:
+        info = c.get(ip)
+        if info is not None:
+            return info
+
+    region = EMPTY_REGION
     try:
-        info = db.search(ip)
+        region = _lookup(searcher, searcher6, ip)
     except:
         pass
+
+    info = IPLocationInfo(ip, region)
+    if c is not None:
+        c.put(ip, info)
+
+    return info
+
+
+def stats() -> dict:
+    """lookup cache counters and lookup counts"""
+    if cache is None:
+        stats = {"size": 0, "items": 0, "hits": 0, "misses": 0, "evictions": 0}
     else:
-        if not info:
-            params = ["", "", "", "", "", ""]
-        else:
-            params = info.split("|")
-            # convert 0 to "0"
-            params = [i if i != "0" else "" for i in params]
+        stats = cache.stats()
 
-    # 国家|区域|省份|城市|ISP，缺省的地域信息默认是0
-    return IPLocationInfo(
-        ip=ip,
-        country=params[0],
-        area=params[1],
-        province=params[2],
-        city=params[3],
-        isp=params[4],
-        info={},
-    )
+    stats["lookups"] = dict(lookups)
+    return stats
+
+
+@dataclass
+class IPLocationBatch:
+    """
+    columnar result of find_many
+
+    ids[i] is the position of ips[i] region in the shared regions table, -1 means invalid address or not found
+    """
+
+    ips: Sequence[str]
+    ids: Sequence[int]
+    regions: List[IPRegion]
+
+    def __len__(self):
+        return len(self.ips)
+
+    def region(self, i: int) -> IPRegion:
+        region_id = self.ids[i]
+        return self.regions[region_id] if region_id >= 0 else EMPTY_REGION
+
+    def infos(self) -> List[IPLocationInfo]:
+        """convert to IPLocationInfo list, region records are shared"""
+        regions = self.regions
+        return [IPLocationInfo(ip, regions[i] if i >= 0 else EMPTY_REGION) for ip, i in zip(self.ips, self.ids)]
+
+
+def find_many(ips: Sequence[str]) -> IPLocationBatch:
+    """find location of many ip addresses at once
+
+    with compiled index, addresses are packed in bulk and resolved by a vectorized numpy searchsorted.
+    numpy is an optional dependency(requirements.txt), without it every address is resolved by a bisect in python,
+    which is only a few times faster than calling find in a loop
+    """
+    searcher = db
+    searcher6 = db6
+
+    if not isinstance(ips, (list, tuple)):
+        ips = list(ips)
+
+    lookups["find_many"] += len(ips)
+
+    # ipv6 positions, ipv4-mapped ones are replaced by their ipv4 address in query
+    query = ips
+    positions = [i for i, ip in enumerate(ips) if isinstance(ip, str) and ":" in ip]
+    if positions:
+        query = list(ips)
+        v6 = []
+        for i in positions:
+            v4 = _unmap(ips[i])
+            if v4 is None:
+                v6.append(i)
+            else:
+                query[i] = v4
+        positions = v6
+
+    if searcher is None:
+        ids = array("i", [-1]) * len(ips)
+        regions = []
+
+    elif isinstance(searcher, XdbIndex):
+        ids = searcher.search_many(query)
+        regions = searcher.records
+
+    else:
+        # xdb walker, build the region table on the fly
+        ids = array("i")
+        regions = []
+        region_ids = {}
+        for ip in query:
+            try:
+                region = searcher.search(ip)
+            except:
+                region = ""
+
+            if not region:
+                ids.append(-1)
+                continue
+
+            region_id = region_ids.get(region)
+            if region_id is None:
+                region_id = region_ids[region] = len(regions)
+                regions.append(_intern_region(region))
+            ids.append(region_id)
+
+    # ipv6 addresses are invalid for the ipv4 database, resolve them and append ipv6 regions to the table
+    if searcher6 is not None and positions:
+        offset = len(regions)
+        regions = list(regions) + searcher6.records
+
+        for i, region_id in zip(positions, searcher6.search_many([ips[i] for i in positions])):
+            ids[i] = region_id + offset if region_id >= 0 else -1
+
+    return IPLocationBatch(ips=ips, ids=ids, regions=regions)
+
+
+def _pack_ips(ips: Sequence[str]):
+    """pack ipv4 addresses into big endian uint32 bytes, return bytes and positions of invalid addresses"""
+    try:
+        # all valid, packed by one join
+        return b"".join(map(socket.inet_aton, ips)), []
+    except (OSError, TypeError):
+        pass
+
+    packed = bytearray(len(ips) * 4)
+    invalid = []
+
+    for i, ip in enumerate(ips):
+        try:
+            packed[i * 4 : i * 4 + 4] = socket.inet_aton(ip)
+        except (OSError, TypeError):
+            invalid.append(i)
+
+    return packed, invalid
+
+
+class XdbIndex(object):
+    """
+    compiled index of the xdb segment table
+
+    all segments are unpacked once into contiguous start/end ip arrays plus a region id array,
+    region payloads are decoded and split once into tables keyed by data pointer,
+    so a lookup is a single bisect over native integers
+    """
+
+    def __init__(self, contentBuff):
+        _, _, _, ptr_start, ptr_end = struct.unpack_from("<HHIII", contentBuff, 0)
+        ptr_end = min(ptr_end + SegmentIndexSize, len(contentBuff))
+        ptr_end -= (ptr_end - ptr_start) % SegmentIndexSize
+
+        self.starts = array("I")
+        self.ends = array("I")
+        self.ids = array("I")
+        # raw region strings and their interned records, same position
+        self.regions = []
+        self.records = []
+
+        region_ids = {}
+        records = {}
+        for sip, eip, data_len, data_ptr in struct.iter_unpack("<IIHI", contentBuff[ptr_start:ptr_end]):
+            region_id = region_ids.get(data_ptr)
+            if region_id is None:
+                region_id = region_ids[data_ptr] = len(self.regions)
+
+                region = bytes(contentBuff[data_ptr : data_ptr + data_len]).decode("utf-8")
+                record = records.get(region)
+                if record is None:
+                    record = records[region] = _parse_region(region)
+
+                self.regions.append(region)
+                self.records.append(record)
+
+            self.starts.append(sip)
+            self.ends.append(eip)
+            self.ids.append(region_id)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __str__(self):
+        return f"XdbIndex(segments:{len(self.starts)},regions:{len(self.regions)})"
+
+    def search(self, ip):
+        if isinstance(ip, str):
+            ip = int(ip) if ip.isdigit() else struct.unpack("!L", socket.inet_aton(ip))[0]
+
+        return self.searchByIPLong(ip)
+
+    def searchByIPLong(self, ip):
+        i = bisect_right(self.starts, ip) - 1
+        if i < 0 or ip > self.ends[i]:
+            return ""
+
+        return self.regions[self.ids[i]]
+
+    def lookup(self, ip) -> IPRegion:
+        """same as search, but return the interned IPRegion record"""
+        if isinstance(ip, str):
+            ip = int(ip) if ip.isdigit() else struct.unpack("!L", socket.inet_aton(ip))[0]
+
+        i = bisect_right(self.starts, ip) - 1
+        if i < 0 or ip > self.ends[i]:
+            return EMPTY_REGION
+
+        return self.records[self.ids[i]]
+
+    def search_many(self, ips):
+        """return region ids of ips, -1 means invalid address or not found"""
+        packed, invalid = _pack_ips(ips)
+
+        if numpy is not None:
+            keys = numpy.frombuffer(packed, dtype=">u4")
+            starts = numpy.frombuffer(self.starts, dtype=self.starts.typecode)
+            ends = numpy.frombuffer(self.ends, dtype=self.ends.typecode)
+            region_ids = numpy.frombuffer(self.ids, dtype=self.ids.typecode)
+
+            pos = numpy.searchsorted(starts, keys, side="right") - 1
+            found = pos >= 0
+            pos[~found] = 0
+            found &= keys <= ends[pos]
+
+            ids = numpy.where(found, region_ids[pos], -1).astype(numpy.int32)
+            ids[invalid] = -1
+            return ids
+
+        ids = array("i")
+        for key in struct.unpack(f"!{len(ips)}L", packed):
+            i = bisect_right(self.starts, key) - 1
+            if i < 0 or key > self.ends[i]:
+                ids.append(-1)
+            else:
+                ids.append(self.ids[i])
+
+        for i in invalid:
+            ids[i] = -1
+        return ids
+
+
+class IPv6Index(object):
+    """
+    compiled index of ipv6 segments, same lookup interface as XdbIndex
+
+    128 bit addresses do not fit native arrays, so starts/ends are sorted lists of python int
+    """
+
+    def __init__(self, segments: Iterable[Tuple[int, int, str]]):
+        self.starts = []
+        self.ends = []
+        self.ids = array("I")
+        self.regions = []
+        self.records = []
+
+        region_ids = {}
+        for sip, eip, region in sorted(segments):
+            region_id = region_ids.get(region)
+            if region_id is None:
+                region_id = region_ids[region] = len(self.regions)
+                self.regions.append(region)
+                self.records.append(_parse_region(region))
+
+            self.starts.append(sip)
+            self.ends.append(eip)
+            self.ids.append(region_id)
+
+    @classmethod
+    def load_from_file(cls, path: str) -> "IPv6Index":
+        """load ip2region source format file, start|end|country|area|province|city|isp per line"""
+        segments = []
+        with io.open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                sip, eip, region = line.split("|", 2)
+                segments.append((cls.ip2long(sip), cls.ip2long(eip), region))
+
+        return cls(segments)
+
+    @staticmethod
+    def ip2long(ip: str) -> int:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __str__(self):
+        return f"IPv6Index(segments:{len(self.starts)},regions:{len(self.regions)})"
+
+    def _position(self, ip) -> int:
+        if isinstance(ip, str):
+            ip = self.ip2long(ip)
+
+        i = bisect_right(self.starts, ip) - 1
+        if i < 0 or ip > self.ends[i]:
+            return -1
+        return i
+
+    def search(self, ip) -> str:
+        i = self._position(ip)
+        return self.regions[self.ids[i]] if i >= 0 else ""
+
+    def lookup(self, ip) -> IPRegion:
+        i = self._position(ip)
+        return self.records[self.ids[i]] if i >= 0 else EMPTY_REGION
+
+    def search_many(self, ips):
+        """return region ids of ips, -1 means invalid address or not found"""
+        ids = array("i")
+        for ip in ips:
+            try:
+                i = self._position(ip)
+            except (OSError, TypeError, ValueError):
+                i = -1
+            ids.append(self.ids[i] if i >= 0 else -1)
+        return ids
 
 
 # {{{ COPY FROM https://github.com/lionsoul2014/ip2region/raw/master/binding/python/xdbSearcher.py
@@ -236,7 +882,7 @@ class XdbSearcher(object):
             return ""
 
         buffer_string = self.readBuffer(dataPtr, dataLen)
-        return_string = buffer_string.decode("utf-8")
+        return_string = str(buffer_string, "utf-8")
         return return_string
 
     def readBuffer(self, offset, length):
@@ -293,7 +939,7 @@ class XdbSearcher(object):
         return 0
 
     def getInt2(self, b, offset):
-        return (b[offset] & 0x000000FF) | (b[offset + 1] & 0x0000FF00)
+        return (b[offset] & 0x000000FF) | ((b[offset + 1] << 8) & 0x0000FF00)
 
     def close(self):
         if self.__f is not None:
@@ -1,6 +1,17 @@
-from .ipgeo import load, find
+from . import ipgeo
+from .ipgeo import load, find, find_many, IPRegion, PATH_DB, XdbIndex, XdbSearcher
 import asyncio
+import errno
+import os
+import random
+import socket
+import struct
+import tempfile
 import unittest
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
 ADDRESS_LIST = {
     "8.8.8.8": {"country": "美国", "area": "", "province": "", "city": "", "isp": "Level3", "info": {}},
@@ -11,6 +22,79 @@ ADDRESS_LIST = {
 }
 
 
+def ip2long(ip):
+    return struct.unpack("!L", socket.inet_aton(ip))[0]
+
+
+def make_xdb(segments):
+    """build a xdb(v2, vector index policy) content from sorted (start ip, end ip, region) segments
+
+    gaps are filled with the default region, segments are split on the /16 boundary like the ip2region maker
+    """
+    filled = []
+    last = 0
+    for sip, eip, region in segments:
+        if sip > last:
+            filled.append((last, sip - 1, "0|0|0|0|0"))
+        filled.append((sip, eip, region))
+        last = eip + 1
+    if last <= 0xFFFFFFFF:
+        filled.append((last, 0xFFFFFFFF, "0|0|0|0|0"))
+
+    vector = bytearray(256 * 256 * 8)
+    data = bytearray()
+    data_ptrs = {}
+    ptr_base = 256 + len(vector)
+    for _, _, region in filled:
+        if region not in data_ptrs:
+            data_ptrs[region] = ptr_base + len(data)
+            data += region.encode()
+
+    index = bytearray()
+    ptr_index = ptr_base + len(data)
+    for sip, eip, region in filled:
+        size = len(region.encode())
+        while sip <= eip:
+            end = min(eip, sip | 0xFFFF)
+            ptr = ptr_index + len(index)
+            index += struct.pack("<IIHI", sip, end, size, data_ptrs[region])
+
+            offset = (sip >> 16) * 8
+            if struct.unpack_from("<I", vector, offset)[0] == 0:
+                struct.pack_into("<I", vector, offset, ptr)
+            struct.pack_into("<I", vector, offset + 4, ptr + 14)
+
+            sip = end + 1
+
+    header = bytearray(256)
+    struct.pack_into("<HHIII", header, 0, 2, 1, 0, ptr_index, ptr_index + len(index) - 14)
+    return bytes(header + vector + data + index)
+
+
+FIXTURE_SEGMENTS = [
+    (ip2long("8.8.4.0"), ip2long("8.8.4.255"), "美国|0|新泽西|0|Level3"),
+    (ip2long("8.8.8.0"), ip2long("8.8.8.255"), "美国|0|0|0|Level3"),
+    (ip2long("114.114.0.0"), ip2long("114.115.255.255"), "中国|0|江苏省|南京市|0"),
+    (ip2long("119.29.0.0"), ip2long("119.29.63.255"), "中国|0|北京|北京市|腾讯"),
+    (ip2long("223.4.0.0"), ip2long("223.7.255.255"), "中国|0|浙江省|杭州市|阿里云"),
+]
+
+
+FIXTURE_V6_SOURCE = """# start|end|country|area|province|city|isp
+2001:4860::|2001:4860:ffff:ffff:ffff:ffff:ffff:ffff|美国|0|0|0|Google
+240e::|240e:ffff:ffff:ffff:ffff:ffff:ffff:ffff|中国|0|0|0|电信
+2400:3200::|2400:3200:ffff:ffff:ffff:ffff:ffff:ffff|中国|0|浙江省|杭州市|阿里云
+"""
+
+
+def random_ips(count, seed=0):
+    rnd = random.Random(seed)
+    ips = [rnd.randint(0, 0xFFFFFFFF) for _ in range(count)]
+    for sip, eip, _ in FIXTURE_SEGMENTS:
+        ips.extend([sip - 1, sip, eip, eip + 1])
+    return [socket.inet_ntoa(struct.pack("!L", i)) for i in ips]
+
+
 class TestIpGeo(unittest.TestCase):
     def test_load(self):
         asyncio.run(load())
@@ -27,3 +111,310 @@ class TestIpGeo(unittest.TestCase):
             self.assertEqual(info.city, ip_check_info["city"])
             self.assertEqual(info.isp, ip_check_info["isp"])
             self.assertEqual(info.info, ip_check_info["info"])
+
+    def test_from_fields(self):
+        info = ipgeo.IPLocationInfo.from_fields("1.2.3.4", "中国", "", "广东省", "深圳市", "电信", info={"k": 1})
+        self.assertEqual(info.province, "广东省")
+        self.assertEqual(info.isp, "电信")
+        self.assertEqual(info.dump(), {"ip": "1.2.3.4", "country": "中国", "area": "", "province": "广东省", "city": "深圳市", "isp": "电信", "info": {"k": 1}})
+        self.assertEqual(ipgeo.IPLocationInfo.from_fields(ip="1.2.3.4").dump()["info"], {})
+
+    @unittest.skipUnless(os.path.isfile(PATH_DB), f"{PATH_DB} not exist")
+    def test_cache(self):
+        asyncio.run(load(cache_size=2))
+
+        count = ipgeo.lookups["find"]
+        first = find("8.8.8.8")
+        self.assertIs(find("8.8.8.8"), first)
+        find("8.8.4.4")
+        find("223.5.5.5")
+        stats = ipgeo.stats()
+        self.assertEqual(stats.pop("lookups")["find"], count + 4)
+        self.assertEqual(stats, {"size": 2, "items": 2, "hits": 1, "misses": 3, "evictions": 1})
+
+        # reload drop old results
+        asyncio.run(load(cache_size=2))
+        self.assertEqual(ipgeo.stats()["items"], 0)
+        self.assertIsNot(find("8.8.8.8"), first)
+        self.assertEqual(find("8.8.8.8"), first)
+
+        asyncio.run(load())
+        self.assertEqual(ipgeo.stats()["size"], 0)
+
+
+class TestXdbIndex(unittest.TestCase):
+    def assertSameAnswers(self, content, ips):
+        searcher = XdbSearcher(contentBuff=content)
+        index = XdbIndex(contentBuff=content)
+
+        for ip in ips:
+            self.assertEqual(index.search(ip), searcher.search(ip), ip)
+
+    def test_fixture(self):
+        content = make_xdb(FIXTURE_SEGMENTS)
+        index = XdbIndex(contentBuff=content)
+
+        self.assertEqual(index.search("8.8.8.8"), "美国|0|0|0|Level3")
+        self.assertEqual(index.search("223.5.5.5"), "中国|0|浙江省|杭州市|阿里云")
+        self.assertEqual(index.search(ip2long("119.29.29.29")), "中国|0|北京|北京市|腾讯")
+
+        self.assertSameAnswers(content, list(ADDRESS_LIST) + random_ips(5000))
+
+    def test_lookup(self):
+        index = XdbIndex(contentBuff=make_xdb(FIXTURE_SEGMENTS))
+
+        region = index.lookup("114.114.114.114")
+        self.assertEqual(region, IPRegion("中国", "", "江苏省", "南京市", ""))
+        self.assertIs(index.lookup("114.115.0.1"), region)
+        self.assertEqual(len(index.records), len(set(index.regions)))
+
+        db = ipgeo.db
+        ipgeo.db = index
+        try:
+            info = find("114.114.114.114")
+        finally:
+            ipgeo.db = db
+
+        self.assertIs(info.region, region)
+        self.assertEqual(info.city, "南京市")
+        self.assertEqual(info.dump()["province"], "江苏省")
+        with self.assertRaises(AttributeError):
+            info.city = ""
+        with self.assertRaises(AttributeError):
+            info.extra = ""
+
+    def test_mapped(self):
+        content = make_xdb(FIXTURE_SEGMENTS)
+
+        with tempfile.TemporaryDirectory() as path:
+            dbfile = os.path.join(path, "ip2region.db")
+            with open(dbfile, "wb") as f:
+                f.write(content)
+
+            mapped = ipgeo._map_content(dbfile)
+            self.assertIsInstance(mapped, memoryview)
+
+            searcher = XdbSearcher(contentBuff=mapped)
+            index = XdbIndex(contentBuff=mapped)
+            expected = XdbSearcher(contentBuff=content)
+
+            for ip in list(ADDRESS_LIST) + random_ips(2000):
+                self.assertEqual(searcher.search(ip), expected.search(ip), ip)
+                self.assertEqual(index.search(ip), expected.search(ip), ip)
+
+            searcher.close()
+            del searcher, mapped
+
+            # mapped mode walks the map instead of compiling a private copy
+            searcher = ipgeo._build(dbfile, compiled=True, mapped=True)
+            self.assertIsInstance(searcher, XdbSearcher)
+            self.assertIsInstance(searcher.contentBuff, memoryview)
+            self.assertEqual(searcher.search("1.2.3.4"), expected.search("1.2.3.4"))
+            searcher.close()
+            del searcher
+
+    @unittest.skipUnless(os.path.isfile(PATH_DB), f"{PATH_DB} not exist")
+    def test_database(self):
+        with open(PATH_DB, "rb") as f:
+            content = f.read()
+
+        self.assertSameAnswers(content, list(ADDRESS_LIST) + random_ips(20000))
+
+
+class TestFindMany(unittest.TestCase):
+    def setUp(self):
+        self.db = ipgeo.db
+        self.numpy = ipgeo.numpy
+
+    def tearDown(self):
+        ipgeo.db = self.db
+        ipgeo.numpy = self.numpy
+
+    def assertSameAsFind(self, ips):
+        batch = find_many(ips)
+        self.assertEqual(len(batch), len(ips))
+        self.assertEqual(batch.infos(), [find(ip) for ip in ips])
+
+    def test_find_many(self):
+        content = make_xdb(FIXTURE_SEGMENTS)
+        ips = list(ADDRESS_LIST) + random_ips(5000) + ["", "not ip", "1.2.3.4.5"]
+
+        ipgeo.db = XdbIndex(contentBuff=content)
+        self.assertSameAsFind(ips)
+
+        batch = find_many(ips)
+        self.assertEqual(batch.region(0), IPRegion("美国", "", "", "", "Level3"))
+        self.assertIs(batch.region(0), find("8.8.8.8").region)
+        self.assertEqual(list(batch.ids[-3:]), [-1, -1, -1])
+
+        ipgeo.numpy = None
+        self.assertSameAsFind(ips)
+
+        ipgeo.db = XdbSearcher(contentBuff=content)
+        self.assertSameAsFind(ips)
+
+        ipgeo.db = None
+        self.assertSameAsFind(ips)
+
+
+class TestUpdate(unittest.TestCase):
+    def setUp(self):
+        self.saved = {k: getattr(ipgeo, k) for k in ["db", "db6", "cache", "PATH_DB", "PATH_DB_V6", "URLS_DB", "_digest", "_validators"]}
+        self.tmp = tempfile.TemporaryDirectory()
+
+        ipgeo.PATH_DB = os.path.join(self.tmp.name, "ip2region.db")
+        ipgeo.PATH_DB_V6 = os.path.join(self.tmp.name, "ipv6_source.txt")
+        ipgeo._digest = None
+        ipgeo._validators = {}
+        self.saved_numpy = ipgeo.numpy
+
+    def tearDown(self):
+        for k, v in self.saved.items():
+            setattr(ipgeo, k, v)
+        self.tmp.cleanup()
+
+    def test_serve(self):
+        with open(ipgeo.PATH_DB, "wb") as f:
+            f.write(make_xdb(FIXTURE_SEGMENTS))
+
+        ipgeo.db = None
+        self.assertFalse(ipgeo.ready())
+        self.assertEqual(find("8.8.8.8").country, "")
+
+        asyncio.run(ipgeo.serve())
+        self.assertTrue(ipgeo.ready())
+        self.assertEqual(find("8.8.8.8").country, "美国")
+
+    def test_ipv6(self):
+        with open(ipgeo.PATH_DB, "wb") as f:
+            f.write(make_xdb(FIXTURE_SEGMENTS))
+        with open(ipgeo.PATH_DB_V6, "w", encoding="utf-8") as f:
+            f.write(FIXTURE_V6_SOURCE)
+
+        ipgeo.db = ipgeo.db6 = None
+        asyncio.run(load())
+        self.assertEqual(len(ipgeo.db6), 3)
+
+        self.assertEqual(find("2001:4860:4860::8888").isp, "Google")
+        self.assertEqual(find("2400:3200::1").city, "杭州市")
+        self.assertEqual(find("2400:3201::1").country, "")
+        self.assertEqual(find("::ffff:zz").country, "")
+        self.assertEqual(find("8.8.8.8").isp, "Level3")
+
+        # ipv4-mapped addresses are searched in the ipv4 database
+        self.assertEqual(find("::ffff:8.8.8.8").isp, "Level3")
+        self.assertEqual(find("::FFFF:df05:0505").city, "杭州市")
+
+        ips = ["240e:1::1", "8.8.8.8", "2001:4860::", "fe80::1", "223.5.5.5", "2400:3200::", "::ffff:8.8.8.8"]
+        batch = find_many(ips)
+        self.assertEqual(batch.infos(), [find(ip) for ip in ips])
+        self.assertEqual([batch.region(i).isp for i in range(len(ips))], ["电信", "Level3", "Google", "", "阿里云", "阿里云", "Level3"])
+        self.assertEqual(batch.ips[-1], "::ffff:8.8.8.8")
+
+        ipgeo.numpy = None
+        try:
+            self.assertEqual(find_many(ips).infos(), [find(ip) for ip in ips])
+        finally:
+            ipgeo.numpy = self.saved_numpy
+
+    def test_map_error(self):
+        with open(ipgeo.PATH_DB, "wb") as f:
+            f.write(make_xdb(FIXTURE_SEGMENTS))
+
+        # not a content error, the database is kept
+        ipgeo.db = None
+        with mock.patch.object(ipgeo.mmap, "mmap", side_effect=OSError(errno.ENOMEM, "Cannot allocate memory")):
+            with self.assertRaises(OSError):
+                asyncio.run(load(mapped=True))
+        self.assertFalse(ipgeo.ready())
+        self.assertTrue(os.path.isfile(ipgeo.PATH_DB))
+
+        asyncio.run(load(mapped=True))
+        self.assertEqual(find("8.8.8.8").country, "美国")
+
+    def test_broken_ipv6(self):
+        with open(ipgeo.PATH_DB, "wb") as f:
+            f.write(make_xdb(FIXTURE_SEGMENTS))
+        with open(ipgeo.PATH_DB_V6, "w", encoding="utf-8") as f:
+            f.write(FIXTURE_V6_SOURCE + "badline\n")
+
+        # ipv4 is still served
+        ipgeo.db = ipgeo.db6 = None
+        asyncio.run(ipgeo.serve())
+        self.assertTrue(ipgeo.ready())
+        self.assertIsNone(ipgeo.db6)
+        self.assertEqual(find("8.8.8.8").isp, "Level3")
+        self.assertEqual(find("2001:4860::").isp, "")
+
+    def test_update(self):
+        old = make_xdb(FIXTURE_SEGMENTS)
+        new = make_xdb([(ip2long("8.8.8.0"), ip2long("8.8.8.255"), "美国|0|0|0|Google")])
+        newer = make_xdb([(ip2long("8.8.8.0"), ip2long("8.8.8.255"), "美国|0|0|0|Google LLC")])
+
+        with open(ipgeo.PATH_DB, "wb") as f:
+            f.write(old)
+        ipgeo._swap(XdbIndex(contentBuff=old), 16)
+
+        requests = []
+        flaky = []
+
+        async def handler(request):
+            requests.append(dict(request.headers))
+            if request.headers.get("If-None-Match") == '"v2"' and request.query.get("etag") != "ignore":
+                return web.Response(status=304)
+            if request.query.get("truncate"):
+                return web.Response(body=new[: len(new) // 2], headers={"ETag": '"v3"'})
+            if request.query.get("flaky"):
+                # truncated once, then the full content under the same etag
+                if request.headers.get("If-None-Match") == '"v4"':
+                    return web.Response(status=304)
+                flaky.append(1)
+                body = newer if len(flaky) > 1 else newer[: len(newer) // 2]
+                return web.Response(body=body, headers={"ETag": '"v4"'})
+            return web.Response(body=new, headers={"ETag": '"v2"'})
+
+        async def run():
+            app = web.Application()
+            app.router.add_get("/ip2region.xdb", handler)
+            server = TestServer(app, host="127.0.0.1")
+            await server.start_server()
+
+            try:
+                url = str(server.make_url("/ip2region.xdb"))
+                ipgeo.URLS_DB = [str(server.make_url("/missing")), url]
+
+                self.assertEqual(find("8.8.8.8").isp, "Level3")
+                self.assertTrue(await ipgeo.update(cache_size=16))
+                self.assertEqual(find("8.8.8.8").isp, "Google")
+                self.assertEqual(ipgeo.stats()["items"], 1)
+
+                # not modified
+                self.assertFalse(await ipgeo.update())
+                self.assertEqual(requests[-1]["If-None-Match"], '"v2"')
+
+                # same content
+                ipgeo.URLS_DB = [url + "?etag=ignore"]
+                self.assertFalse(await ipgeo.update())
+                self.assertEqual(find("8.8.8.8").isp, "Google")
+
+                # truncated content is rejected
+                ipgeo.URLS_DB = [url + "?etag=ignore&truncate=1"]
+                with self.assertRaises(ValueError):
+                    await ipgeo.update()
+                self.assertEqual(find("8.8.8.8").isp, "Google")
+
+                # validators of a broken download are not kept
+                ipgeo.URLS_DB = [url + "?flaky=1"]
+                with self.assertRaises(ValueError):
+                    await ipgeo.update()
+                self.assertTrue(await ipgeo.update())
+                self.assertNotIn("If-None-Match", requests[-1])
+                self.assertEqual(find("8.8.8.8").isp, "Google LLC")
+            finally:
+                await server.close()
+
+        asyncio.run(run())
+
+        with open(ipgeo.PATH_DB, "rb") as f:
+            self.assertEqual(f.read(), newer)
+        self.assertEqual(os.listdir(self.tmp.name), ["ip2region.db"])
@@ -1,3 +1,10 @@
+import atexit
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
 from loguru import logger
 
 for name, config in {
@@ -5,10 +12,20 @@ for name, config in {
     "info": ["10 mb", "6 months", lambda r: "is_info" in r["extra"]],
     "warning": ["10 mb", "3 months", lambda r: "is_warning" in r["extra"]],
     "error": ["20 mb", "6 months", lambda r: "is_error" in r["extra"]],
-    "access": ["50 mb", "12 months", lambda r: "is_access" in r["extra"]],
 }.items():
     logger.add(f"log/{name}.log", rotation=config[0], retention=config[1], compression="gz", buffering=2048, filter=config[2])
 
+# access records are written in batches, one record holds many formatted lines
+logger.add(
+    "log/access.log",
+    rotation="50 mb",
+    retention="12 months",
+    compression="gz",
+    buffering=65536,
+    format="{message}",
+    filter=lambda r: "is_access" in r["extra"],
+)
+
 logger_debug = logger.bind(is_debug=True)
 logger_info = logger.bind(is_info=True)
 logger_warning = logger.bind(is_warning=True)
@@ -26,12 +43,100 @@ error = logger_error.error
 exception = logger_error.exception
 
 
-def access(request, exception=None):
-    remote = request.remote
-    url = request.url
+class AccessLog(object):
+    """bounded buffer of access records, drained by a writer thread in batches
+
+    push never blocks the event loop, records are dropped and counted when the buffer is full
+    """
+
+    def __init__(self, size: int = 65536, interval: float = 0.5, batch: int = 1024):
+        self.size = size
+        self.interval = interval
+        self.batch = batch
+
+        # (ts, remote, method, path, status, latency)
+        self.records = deque()
+
+        self.written = 0
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopped = False
+
+        # once, start runs again after every stop
+        atexit.register(self.stop)
+
+    def push(self, record: tuple):
+        if len(self.records) >= self.size:
+            self.dropped += 1
+            return
+
+        self.records.append(record)
+
+        if self._thread is None:
+            self.start()
+        elif len(self.records) >= self.batch:
+            self._wake.set()
+
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="access-log", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop the writer and write the rest"""
+        self._stopped = True
+        self._wake.set()
+
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(5)
+
+        self.flush()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            try:
+                self.flush()
+            except Exception as e:
+                logger_error.error(f"access log write error:{e}")
+
+    def flush(self):
+        with self._lock:
+            records = self.records
+            lines = []
+            while records and len(lines) < self.size:
+                ts, remote, method, path, status, latency = records.popleft()
+                ts = datetime.fromtimestamp(ts).isoformat(sep=" ", timespec="milliseconds")
+                lines.append(f"{ts} | {remote} - {method} {path} - {status} {latency * 1000:.1f}ms")
+
+                if len(lines) >= self.batch:
+                    logger_access.info("\n".join(lines))
+                    self.written += len(lines)
+                    lines = []
+
+            if lines:
+                logger_access.info("\n".join(lines))
+                self.written += len(lines)
+
+    def stats(self) -> dict:
+        return {"size": self.size, "pending": len(self.records), "written": self.written, "dropped": self.dropped}
+
+
+access_log = AccessLog()
+
+
+def access(request, exception=None, status: Optional[int] = None, latency: float = 0.0):
+    """queue an access record of request, latency in seconds
 
-    if exception is None:
-        logger_access.info(f"{remote} - {url}")
-        return
+    status defaults to the code of exception(ErrorBasic), or 200 without it
+    """
+    if status is None:
+        status = getattr(exception, "code", 200) if exception is not None else 200
 
-    logger_access.info(f"{remote} - {url} - {exception.code}:{exception.error}")
+    access_log.push((time.time(), request.remote, request.method, request.path_qs, status, latency))
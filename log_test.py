@@ -0,0 +1,61 @@
+from . import log
+from .exception import InvalidParams
+from .log import AccessLog
+import time
+import unittest
+
+from loguru import logger
+
+
+class TestAccessLog(unittest.TestCase):
+    def setUp(self):
+        self.lines = []
+        self.sink = logger.add(lambda m: self.lines.extend(m.record["message"].split("\n")), filter=lambda r: "is_access" in r["extra"])
+
+    def tearDown(self):
+        logger.remove(self.sink)
+
+    def test_batch(self):
+        access = AccessLog(size=3, interval=0.01, batch=2)
+        for i in range(5):
+            access.push((time.time(), "127.0.0.1", "GET", f"/items?page={i}", 200, 0.0012))
+
+        # full buffer drops instead of blocking
+        self.assertEqual(access.dropped, 2)
+
+        for _ in range(100):
+            if access.written == 3:
+                break
+            time.sleep(0.01)
+        access.stop()
+
+        self.assertEqual(access.stats(), {"size": 3, "pending": 0, "written": 3, "dropped": 2})
+        self.assertEqual(len(self.lines), 3)
+        self.assertTrue(self.lines[0].endswith("| 127.0.0.1 - GET /items?page=0 - 200 1.2ms"), self.lines[0])
+
+    def test_stop(self):
+        access = AccessLog(interval=60)
+        access.push((time.time(), "127.0.0.1", "POST", "/", 404, 0.5))
+        access.stop()
+
+        self.assertEqual(access.written, 1)
+        self.assertIn("POST / - 404 500.0ms", self.lines[0])
+
+    def test_access(self):
+        class Request:
+            remote = "10.0.0.1"
+            method = "GET"
+            path_qs = "/a?b=1"
+
+        pending = len(log.access_log.records)
+        log.access(Request(), status=201, latency=0.001)
+        self.assertLessEqual(len(log.access_log.records), pending + 1)
+        log.access_log.flush()
+        self.assertTrue(any(i.endswith("| 10.0.0.1 - GET /a?b=1 - 201 1.0ms") for i in self.lines), self.lines)
+
+        # old callers
+        log.access(Request())
+        log.access(Request(), InvalidParams())
+        log.access_log.flush()
+        self.assertTrue(self.lines[-2].endswith("| 10.0.0.1 - GET /a?b=1 - 200 0.0ms"), self.lines)
+        self.assertTrue(self.lines[-1].endswith("| 10.0.0.1 - GET /a?b=1 - 400 0.0ms"), self.lines)
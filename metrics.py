@@ -0,0 +1,91 @@
+import bisect
+from typing import Dict, Iterable, List, Tuple
+
+# upper bounds in seconds, 0.5ms .. ~33s by power of 2
+BUCKETS = tuple(0.0005 * 2**i for i in range(17))
+
+# record per request metrics, set by Application from [http] metrics
+enabled = False
+
+
+class Histogram(object):
+    """fixed log bucket histogram, observe is one bisect and three adds"""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...] = BUCKETS):
+        self.bounds = bounds
+        # the last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """upper bound of the bucket holding the q quantile, inf when it is over the last bound"""
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        total = 0
+        for i, n in enumerate(self.counts):
+            total += n
+            if total >= rank:
+                return self.bounds[i] if i < len(self.bounds) else float("inf")
+
+        return float("inf")
+
+
+# (route, method, status) -> latency of handler
+requests: Dict[Tuple[str, str, int], Histogram] = {}
+
+# read: read the body, parse: json parse of request.data
+body = {"read": Histogram(), "parse": Histogram()}
+
+
+def observe_request(route: str, method: str, status: int, seconds: float):
+    k = (route, method, status)
+    h = requests.get(k)
+    if h is None:
+        h = requests[k] = Histogram()
+    h.observe(seconds)
+
+
+def _labels(labels: Dict[str, object]) -> str:
+    if not labels:
+        return ""
+
+    items = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        items.append(f'{k}="{v}"')
+    return "{" + ",".join(items) + "}"
+
+
+def render_histogram(name: str, help: str, items: Iterable[Tuple[Dict[str, object], Histogram]]) -> List[str]:
+    """prometheus text lines of histograms, cumulative buckets"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+    for labels, h in items:
+        total = 0
+        for bound, n in zip((*h.bounds, "+Inf"), h.counts):
+            total += n
+            le = bound if isinstance(bound, str) else f"{bound:g}"
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': le})} {total}")
+
+        lines.append(f"{name}_sum{_labels(labels)} {h.sum:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {h.count}")
+
+    return lines
+
+
+def render_values(name: str, help: str, kind: str, items: Iterable[Tuple[Dict[str, object], float]]) -> List[str]:
+    """prometheus text lines of counters or gauges"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in items:
+        lines.append(f"{name}{_labels(labels)} {value}")
+
+    return lines
@@ -0,0 +1,38 @@
+from . import metrics
+from .metrics import Histogram
+import unittest
+
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        h = Histogram((0.001, 0.01, 0.1))
+        for v in (0.0005, 0.001, 0.002, 0.05, 0.5):
+            h.observe(v)
+
+        self.assertEqual(h.counts, [2, 1, 1, 1])
+        self.assertEqual(h.count, 5)
+        self.assertAlmostEqual(h.sum, 0.5535)
+        self.assertEqual(h.quantile(0.5), 0.01)
+        self.assertEqual(h.quantile(0.99), float("inf"))
+        self.assertEqual(Histogram().quantile(0.5), 0.0)
+
+    def test_render(self):
+        h = Histogram((0.001, 0.01))
+        h.observe(0.002)
+        h.observe(1)
+
+        lines = metrics.render_histogram("latency_seconds", "latency", [({"route": '/a/{id}"'}, h)])
+        self.assertEqual(
+            lines,
+            [
+                "# HELP latency_seconds latency",
+                "# TYPE latency_seconds histogram",
+                'latency_seconds_bucket{route="/a/{id}\\"",le="0.001"} 0',
+                'latency_seconds_bucket{route="/a/{id}\\"",le="0.01"} 1',
+                'latency_seconds_bucket{route="/a/{id}\\"",le="+Inf"} 2',
+                'latency_seconds_sum{route="/a/{id}\\""} 1.002000',
+                'latency_seconds_count{route="/a/{id}\\""} 2',
+            ],
+        )
+
+        self.assertEqual(metrics.render_values("up", "up", "gauge", [({}, 1)]), ["# HELP up up", "# TYPE up gauge", "up 1"])
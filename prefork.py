@@ -0,0 +1,213 @@
+import asyncio
+import os
+import signal
+import socket
+import time
+from typing import Callable, Dict, Optional
+
+from aiohttp import web
+
+from .log import access_log, error, info, logger, warning
+
+# worker died within it after start is restarted after a pause, avoid a fork loop
+RESTART_PAUSE = 1.0
+
+
+def bind(host: str, port: int, backlog: int = 1024) -> socket.socket:
+    """listening socket shared by all workers"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def _exit(code: int):
+    """os._exit skips atexit, write the buffered access records and log sinks first"""
+    try:
+        access_log.stop()
+        logger.remove()
+    finally:
+        os._exit(code)
+
+
+def _worker(app: web.Application, host: str, port: int, sock: Optional[socket.socket], graceful_timeout: float):
+    """run app in the forked process, on its own event loop"""
+    # handlers of the master are inherited, the loop sets its own on startup
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+    # the loop created before fork shares its epoll with the master, drop it
+    try:
+        app.loop.close()
+    except Exception:
+        pass
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app.bind_loop(loop)
+
+    if sock is None:
+        # every worker binds the port, the kernel balances connections
+        web.run_app(app, host=host, port=port, reuse_port=True, shutdown_timeout=graceful_timeout, print=None, loop=loop)
+    else:
+        web.run_app(app, sock=sock, shutdown_timeout=graceful_timeout, print=None, loop=loop)
+
+
+def _helper(helper: Callable[[], None]):
+    """run helper in the forked process, with default stop signals instead of the handlers of the master"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    helper()
+
+
+def run(
+    app: web.Application,
+    host: str,
+    port: int,
+    workers: int,
+    reuse_port: bool = True,
+    graceful_timeout: float = 30,
+    helper: Optional[Callable[[], None]] = None,
+):
+    """prefork workers and supervise them
+
+    workers are restarted when they exit, SIGUSR1 is forwarded to workers(reload),
+    SIGTERM/SIGINT stop workers gracefully, and they are killed after graceful_timeout
+
+    helper runs in its own process next to workers, e.g. to download shared data once, so the master keeps supervising.
+    it sends SIGUSR2 to the master(os.getppid()) when the data changed, app.refreshed() is called
+    and the signal is forwarded to workers. a failed helper is restarted, one exits with 0 is done
+    """
+    sock = None if reuse_port and hasattr(socket, "SO_REUSEPORT") else bind(host, port)
+
+    children: Dict[int, float] = {}  # pid -> started at
+    state = {"stopping": 0.0, "helper": 0, "helper_started": 0.0}
+
+    def fork(target, *args) -> int:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                target(*args)
+            except BaseException as e:
+                error(f"process {os.getpid()} exit with error:{e}")
+                code = 1
+            finally:
+                _exit(code)
+
+        return pid
+
+    def spawn():
+        pid = fork(_worker, app, host, port, sock, graceful_timeout)
+        children[pid] = time.monotonic()
+        info(f"worker {pid} started")
+
+    def spawn_helper():
+        state["helper"] = fork(_helper, helper)
+        state["helper_started"] = time.monotonic()
+        info(f"helper {state['helper']} started")
+
+    def forward(signum, _):
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        if not state["stopping"]:
+            info(f"stop workers by signal {signum}")
+            state["stopping"] = time.monotonic()
+            forward(signal.SIGTERM, frame)
+
+            if state["helper"]:
+                try:
+                    os.kill(state["helper"], signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def reload(signum, frame):
+        app.reload()
+        forward(signum, frame)
+
+    def refreshed(signum, frame):
+        app.refreshed()
+        forward(signum, frame)
+
+    # the loop of app is not run in the master
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, reload)
+    signal.signal(signal.SIGUSR2, refreshed)
+
+    info(f"prefork {workers} workers on {host}:{port} {'reuse_port' if sock is None else 'shared socket'}")
+    if helper is not None:
+        spawn_helper()
+
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+
+        if pid == 0:
+            if state["stopping"] and time.monotonic() - state["stopping"] > graceful_timeout:
+                warning(f"kill {len(children)} workers after {graceful_timeout}s")
+                forward(signal.SIGKILL, None)
+                state["stopping"] = time.monotonic()
+
+            time.sleep(0.1)
+            continue
+
+        code = os.waitstatus_to_exitcode(status)
+
+        if pid == state["helper"]:
+            state["helper"] = 0
+            if code == 0 or state["stopping"]:
+                info(f"helper {pid} exit({code})")
+                continue
+
+            warning(f"helper {pid} exit({code}), restart")
+            if time.monotonic() - state["helper_started"] < RESTART_PAUSE:
+                time.sleep(RESTART_PAUSE)
+
+            if not state["stopping"]:
+                spawn_helper()
+            continue
+
+        started = children.pop(pid, None)
+        if started is None:
+            continue
+
+        if state["stopping"]:
+            info(f"worker {pid} stopped({code})")
+            continue
+
+        warning(f"worker {pid} exit({code}), restart")
+        if time.monotonic() - started < RESTART_PAUSE:
+            time.sleep(RESTART_PAUSE)
+
+        if not state["stopping"]:
+            spawn()
+
+    if state["helper"]:
+        try:
+            os.kill(state["helper"], signal.SIGKILL)
+            os.waitpid(state["helper"], 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+    if sock is not None:
+        sock.close()
+
+    info("prefork stopped")
@@ -0,0 +1,289 @@
+from .ipgeo_test import FIXTURE_SEGMENTS, make_xdb
+import asyncio
+import functools
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from aiohttp import ClientSession, TCPConnector
+
+# parent directory of the package, the server script imports it from there
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = f"""
+import os
+import sys
+import time
+
+sys.path.insert(0, {ROOT!r})
+from {PACKAGE} import ipgeo, web
+from {PACKAGE}.config import load_config
+
+reloads = 0
+
+
+class App(web.Application):
+    def reload(self):
+        global reloads
+        reloads += 1
+        super().reload()
+
+
+async def pid(request):
+    return {{"pid": os.getpid(), "reloads": reloads, "ipgeo": loaded_by, "ready": ipgeo.ready()}}
+
+
+async def busy(request):
+    # 2ms of cpu
+    end = time.perf_counter() + 0.002
+    while time.perf_counter() < end:
+        pass
+    return {{"pid": os.getpid()}}
+
+
+# no download in tests but from the local url of argv, record processes loading ipgeo
+ipgeo.URLS_DB = [sys.argv[4]] if sys.argv[4] else []
+loaded_by = []
+_load = ipgeo.load
+
+
+async def load(**kwargs):
+    loaded_by.append(os.getpid())
+    return await _load(**kwargs)
+
+
+ipgeo.load = load
+
+section = load_config()["http"]
+section.update(prefork="true", workers=sys.argv[1], port=sys.argv[2], reuse_port=sys.argv[3], graceful_timeout="5")
+App([("get", "/pid", pid), ("get", "/busy", busy)]).start()
+"""
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Server(object):
+    """prefork server in a child process"""
+
+    def __init__(self, workers: int, reuse_port: bool = True, files: Optional[Dict[str, bytes]] = None, ipgeo_url: str = ""):
+        self.port = free_port()
+        # cwd of the server, log and data directories are in it
+        self.tmp = tempfile.TemporaryDirectory()
+
+        for name, content in {"server.py": SCRIPT.encode(), **(files or {})}.items():
+            path = os.path.join(self.tmp.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(content)
+
+        self.proc = subprocess.Popen(
+            [sys.executable, "server.py", str(workers), str(self.port), str(reuse_port).lower(), ipgeo_url],
+            cwd=self.tmp.name,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    async def get(self, session: ClientSession, path: str) -> dict:
+        async with session.get(self.url(path)) as resp:
+            return await resp.json()
+
+    async def ready(self, session: ClientSession):
+        for _ in range(100):
+            try:
+                return await self.get(session, "/pid")
+            except Exception:
+                await asyncio.sleep(0.1)
+        raise TimeoutError("server not ready")
+
+    def stop(self) -> int:
+        if self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGTERM)
+        return self.proc.wait(15)
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class TestPrefork(unittest.TestCase):
+    def run_server(self, workers, test, reuse_port=True, **kwargs):
+        server = Server(workers, reuse_port, **kwargs)
+        self.addCleanup(server.tmp.cleanup)
+
+        async def run():
+            # new connection for every request, so they spread over workers
+            async with ClientSession(connector=TCPConnector(force_close=True)) as session:
+                await server.ready(session)
+                return await test(server, session)
+
+        try:
+            result = asyncio.run(run())
+        except BaseException:
+            server.kill()
+            raise
+
+        self.assertEqual(server.stop(), 0)
+        return result
+
+    async def pids(self, server, session, count, n=200):
+        pids = set()
+        for _ in range(n):
+            pids.add((await server.get(session, "/pid"))["pid"])
+            if len(pids) >= count:
+                break
+        return pids
+
+    def test_supervise(self):
+        async def test(server, session):
+            pids = await self.pids(server, session, 2)
+            self.assertEqual(len(pids), 2)
+            self.assertNotIn(server.proc.pid, pids)
+
+            # killed worker is restarted
+            dead = pids.pop()
+            os.kill(dead, signal.SIGKILL)
+            for _ in range(50):
+                current = await self.pids(server, session, 2, 50)
+                if dead not in current and len(current) == 2:
+                    break
+                await asyncio.sleep(0.2)
+            self.assertEqual(len(current), 2)
+            self.assertNotIn(dead, current)
+
+            # reload is forwarded to workers
+            server.proc.send_signal(signal.SIGUSR1)
+            reloaded = set()
+            for _ in range(200):
+                resp = await server.get(session, "/pid")
+                if resp["reloads"]:
+                    reloaded.add(resp["pid"])
+                if reloaded == current:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(reloaded, current)
+
+            return current
+
+        workers = self.run_server(2, test)
+        for pid in workers:
+            self.assertFalse(alive(pid))
+
+    async def workers_ipgeo(self, server, session):
+        """pid -> (processes loaded ipgeo, ready) of 2 workers, waits until every one is ready"""
+        workers = {}
+        for _ in range(200):
+            resp = await server.get(session, "/pid")
+            workers[resp["pid"]] = (tuple(resp["ipgeo"]), resp["ready"])
+            if len(workers) >= 2 and all(ready for _, ready in workers.values()):
+                break
+            await asyncio.sleep(0.01)
+        return workers
+
+    def test_ipgeo_loaded_once(self):
+        async def test(server, session):
+            workers = await self.workers_ipgeo(server, session)
+
+            # loaded by the master only, and ready in every worker
+            self.assertEqual(len(workers), 2)
+            self.assertEqual(set(workers.values()), {((server.proc.pid,), True)})
+
+        self.run_server(2, test, files={"data/ipgeo/ip2region.db": make_xdb(FIXTURE_SEGMENTS)})
+
+    def test_ipgeo_download(self):
+        with tempfile.TemporaryDirectory() as path:
+            with open(os.path.join(path, "ip2region.xdb"), "wb") as f:
+                f.write(make_xdb(FIXTURE_SEGMENTS))
+
+            httpd = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=path))
+            thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+            thread.start()
+
+            async def test(server, session):
+                # workers serve at once, the helper downloads then signals them to load the file
+                workers = await self.workers_ipgeo(server, session)
+                self.assertEqual(len(workers), 2)
+                self.assertEqual(workers, {pid: ((pid,), True) for pid in workers})
+
+            try:
+                self.run_server(2, test, ipgeo_url=f"http://127.0.0.1:{httpd.server_port}/ip2region.xdb")
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+
+    def test_access_log(self):
+        probe = uuid.uuid4().hex
+        cwd = None
+
+        async def test(server, session):
+            nonlocal cwd
+            cwd = server.tmp.name
+            await server.get(session, f"/pid?probe={probe}")
+
+        self.run_server(2, test)
+
+        # buffered records are written by workers before exit
+        with open(os.path.join(cwd, "log/access.log"), encoding="utf-8") as f:
+            self.assertIn(f"GET /pid?probe={probe} - 200", f.read())
+
+    def test_shared_socket(self):
+        async def test(server, session):
+            return await self.pids(server, session, 2)
+
+        self.assertEqual(len(self.run_server(2, test, reuse_port=False)), 2)
+
+    @unittest.skipUnless((os.cpu_count() or 1) >= 4, "scaling needs 4 cpus, half of them for the load client")
+    def test_scaling(self):
+        duration = 3.0
+        concurrency = 32
+
+        async def load(server, session):
+            count = 0
+            end = time.perf_counter() + duration
+
+            async def client():
+                nonlocal count
+                while time.perf_counter() < end:
+                    await server.get(session, "/busy")
+                    count += 1
+
+            await asyncio.gather(*[client() for _ in range(concurrency)])
+            return count / duration
+
+        workers = min(4, os.cpu_count() // 2)
+        single = self.run_server(1, load)
+        multi = self.run_server(workers, load)
+
+        print(f"\nprefork: 1 worker {single:.0f} req/s, {workers} workers {multi:.0f} req/s, x{multi / single:.2f}")
+        self.assertGreater(multi, single * workers * 0.6)
@@ -1,19 +1,372 @@
-from dataclasses import dataclass, field, fields
+import asyncio
+import base64
+import binascii
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import MISSING, dataclass, field, fields
 from datetime import datetime, timezone
-from typing import Dict, List, Optional
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
 
 from asyncpg import Connection
-from orjson import loads
+from asyncpg.pool import Pool
+from orjson import dumps, loads
 from xid import Xid
 
 from .exception import InvalidParams, ObjectNotFound
+from .metrics import Histogram
+from .utils import LRUCache
+
+# sql text of (model class, operation, columns)
+sql_cache_size = 1024
+# prepared statements kept by every connection, pass them to
+# create_pool(statement_cache_size=..., max_cacheable_statement_size=..., max_cached_statement_lifetime=...)
+statement_cache_size = 256
+# longer statements(like a big create_many) are prepared for every call and not cached by asyncpg
+max_cacheable_statement_size = 1024 * 15
+# 0 keeps statements until evicted, asyncpg re-prepares them every 300s by default
+max_cached_statement_lifetime = 0
+
+_sql_cache = LRUCache(sql_cache_size)
+
+# id of connection settings -> LRUCache(sql), client side mirror of the asyncpg statement cache for estimated counters,
+# dropped by the termination listener of the connection
+_statements: Dict[int, LRUCache] = {}
+
+# wait of pool acquire
+acquire_seconds = Histogram()
+
+# reads go to the primary inside consistent()
+_consistent: ContextVar[bool] = ContextVar("serial_consistent", default=False)
+
+# (model class, key) -> task of GetMethod.get inside identity_map()
+_identity: ContextVar[Optional[dict]] = ContextVar("serial_identity", default=None)
+_identity_stats = {"hits": 0, "misses": 0}
+
+# model class -> LRUCache(key -> record) of GetMethod.get
+_object_caches: Dict[type, LRUCache] = {}
 
 
 def _get_table(cls):
     return getattr(cls, "__table_name__"), getattr(cls, "__table_key__")
 
 
-@dataclass
+def _sql(cls, op: str, columns: tuple, build: Callable[[str, str], str]) -> str:
+    """sql text of the operation on model class, build(table, key) is only called once per columns"""
+    k = (cls, op, columns)
+    q = _sql_cache.get(k)
+    if q is None:
+        q = build(*_get_table(cls))
+        _sql_cache.put(k, q)
+    return q
+
+
+class Cluster:
+    """primary pool with replica pools
+
+    reads of GetMethod/FindMethod are routed to a replica, selected by round_robin or least_busy(fewest used connections),
+    everything else(acquire, fetch, execute, copy...) goes to the primary, so a cluster can replace a single pool.
+    pass cluster.primary or read inside consistent() when a read must see the latest writes
+    """
+
+    def __init__(self, primary: Pool, replicas: Sequence[Pool] = (), select: str = "round_robin"):
+        if select not in ("round_robin", "least_busy"):
+            raise InvalidParams(msg=f"unknown replica select: {select}")
+
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.select = select
+
+        self._next = 0
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def reader(self) -> Pool:
+        """pool for the next read"""
+        if not self.replicas or _consistent.get():
+            return self.primary
+
+        # rotate even for least_busy, so idle replicas share the load
+        n = self._next % len(self.replicas)
+        self._next = n + 1
+        if self.select == "round_robin":
+            return self.replicas[n]
+
+        replicas = self.replicas[n:] + self.replicas[:n]
+        return min(replicas, key=lambda p: (p.get_size() - p.get_idle_size()) / p.get_max_size())
+
+    async def warmup(self, count: int):
+        """open count connections of every pool ahead of traffic"""
+
+        async def ping(pool: Pool):
+            async with pool.acquire() as con:
+                await con.execute("select 1")
+
+        pools = [self.primary, *self.replicas]
+        await asyncio.gather(*[ping(p) for p in pools for _ in range(min(count, p.get_max_size()))])
+
+    async def close(self):
+        await asyncio.gather(*[p.close() for p in [self.primary, *self.replicas]])
+
+    def stats(self) -> List[dict]:
+        """connections of every pool, the primary first"""
+        return [
+            {"role": "primary" if i == 0 else "replica", "size": p.get_size(), "idle": p.get_idle_size(), "max": p.get_max_size()}
+            for i, p in enumerate([self.primary, *self.replicas])
+        ]
+
+
+@contextmanager
+def consistent():
+    """reads inside go to the primary of a cluster, e.g. read after write in one request"""
+    token = _consistent.set(True)
+    try:
+        yield
+    finally:
+        _consistent.reset(token)
+
+
+@contextmanager
+def identity_map():
+    """objects of GetMethod.get inside are loaded once by key and shared, e.g. one identity map per request"""
+    token = _identity.set({})
+    try:
+        yield
+    finally:
+        _identity.reset(token)
+
+
+def _object_cache(cls) -> Optional[LRUCache]:
+    size = getattr(cls, "__cache_size__", 0)
+    if size <= 0:
+        return None
+
+    cache = _object_caches.get(cls)
+    if cache is None:
+        cache = _object_caches[cls] = LRUCache(size, getattr(cls, "__cache_ttl__", 60.0))
+    return cache
+
+
+def _invalidate(cls, key, removed: bool = False):
+    """drop the cached record of key, and the identity map object too when it is removed"""
+    cache = _object_caches.get(cls)
+    if cache is not None:
+        cache.pop(key)
+
+    identity = _identity.get()
+    if removed and identity is not None:
+        identity.pop((cls, key), None)
+
+
+@asynccontextmanager
+async def _acquire(db: Union[Connection, Pool, Cluster], read: bool = False):
+    """acquire a connection when db is a pool, reads of a cluster use a replica"""
+    if isinstance(db, Cluster):
+        db = db.reader() if read else db.primary
+
+    if isinstance(db, Pool):
+        start = time.perf_counter()
+        async with db.acquire() as con:
+            acquire_seconds.observe(time.perf_counter() - start)
+            yield con
+    else:
+        yield db
+
+
+@asynccontextmanager
+async def _transaction(db: Union[Connection, Pool, Cluster], read: bool = False):
+    """transaction on the connection, acquire one first when db is a pool"""
+    async with _acquire(db, read) as con:
+        async with con.transaction():
+            yield con
+
+
+async def _run(db: Union[Connection, Pool, Cluster], method: str, q: str, *args, read: bool = False):
+    """run q by connection method(fetch/fetchrow/fetchval/executemany)
+
+    sql text is stable, so asyncpg prepares it once per connection and keeps it in the connection statement cache,
+    explicit PreparedStatement objects are not used because asyncpg invalidates them when a pooled connection is released
+    """
+    async with _acquire(db, read) as con:
+        if statement_cache_size > 0 and len(q) <= max_cacheable_statement_size:
+            statements = _statement_cache(con)
+            if statements.get(q) is None:
+                statements.put(q, True)
+
+        return await getattr(con, method)(q, *args)
+
+
+def _statement_cache(con: Connection) -> LRUCache:
+    """mirror of the statement cache of con, settings object lives as long as the underlying connection"""
+    key = id(con.get_settings())
+    statements = _statements.get(key)
+    if statements is None:
+        statements = _statements[key] = LRUCache(statement_cache_size)
+        con.add_termination_listener(lambda _: _statements.pop(key, None))
+
+    return statements
+
+
+def stats() -> dict:
+    """sql text cache and statement cache counters
+
+    prepared counters are summed over live connections and estimated by the mirror of serial queries,
+    asyncpg does not expose its cache, statements of other queries share it
+    """
+    prepared = {"connections": 0, "items": 0, "hits": 0, "misses": 0, "evictions": 0}
+    for statements in list(_statements.values()):
+        prepared["connections"] += 1
+        prepared["items"] += len(statements)
+        prepared["hits"] += statements.hits
+        prepared["misses"] += statements.misses
+        prepared["evictions"] += statements.evictions
+
+    return {
+        "sql": _sql_cache.stats(),
+        "prepared": prepared,
+        "objects": {cls.__name__: cache.stats() for cls, cache in list(_object_caches.items())},
+        "identity": dict(_identity_stats),
+    }
+
+
+@lru_cache(maxsize=None)
+def _field_names(cls) -> FrozenSet[str]:
+    return frozenset(i.name for i in fields(cls))
+
+
+def _filters(columns: Sequence[str]) -> str:
+    """where clause of columns, placeholders start from $1"""
+    return " and ".join(f"{k} = ${i + 1}" for i, k in enumerate(columns)) or "true"
+
+
+def _keyset(cls, order: Sequence[str]) -> Tuple[str, ...]:
+    """ordering columns of keyset pagination, the table key is appended as tie breaker"""
+    _, key = _get_table(cls)
+    names = _field_names(cls)
+
+    for i in order:
+        if i not in names:
+            raise InvalidParams(msg=f"unknown field: {i}")
+
+    return tuple(order) if key in order else (*order, key)
+
+
+def _encode_cursor(values: Sequence) -> str:
+    return base64.urlsafe_b64encode(dumps(list(values))).decode()
+
+
+def _decode_cursor(cls, order: Tuple[str, ...], cursor: str) -> list:
+    """values of ordering columns in cursor, datetime fields are restored from iso format"""
+    try:
+        values = loads(base64.urlsafe_b64decode(cursor))
+    except (binascii.Error, ValueError):
+        raise InvalidParams(msg="invalid cursor")
+
+    if not isinstance(values, list) or len(values) != len(order):
+        raise InvalidParams(msg="invalid cursor")
+
+    types = {i.name: i.type for i in fields(cls)}
+    for n, k in enumerate(order):
+        if types[k] in (datetime, "datetime") and isinstance(values[n], str):
+            try:
+                values[n] = datetime.fromisoformat(values[n])
+            except ValueError:
+                raise InvalidParams(msg="invalid cursor")
+
+    return values
+
+
+@lru_cache(maxsize=256)
+def _hydrator(cls, columns: Tuple[str, ...]) -> Callable:
+    """generated function(row) -> object of cls, built once per (cls, columns)
+
+    values are taken by position of the record columns and assigned to the object directly, skipping __init__,
+    fields not in columns are filled by field defaults, unknown columns are ignored.
+    info json text is parsed inline for HasInfoField, other __post_init__ is still called
+    """
+    positions = {k: i for i, k in enumerate(columns)}
+    env = {"cls": cls, "new": object.__new__, "loads": loads}
+    lines = ["def hydrate(row):", "    obj = new(cls)"]
+
+    for i in fields(cls):
+        if i.name in positions:
+            value = f"row[{positions[i.name]}]"
+        elif i.default is not MISSING:
+            env[f"default_{i.name}"] = i.default
+            value = f"default_{i.name}"
+        elif i.default_factory is not MISSING:
+            env[f"factory_{i.name}"] = i.default_factory
+            value = f"factory_{i.name}()"
+        else:
+            raise InvalidParams(msg=f"missing field: {i.name}")
+
+        if i.name == "info" and issubclass(cls, HasInfoField):
+            lines.append(f"    v = {value}")
+            lines.append("    obj.info = loads(v) if v.__class__ is str else v")
+        else:
+            lines.append(f"    obj.{i.name} = {value}")
+
+    post_init = getattr(cls, "__post_init__", None)
+    if post_init is not None and post_init is not HasInfoField.__post_init__:
+        lines.append("    obj.__post_init__()")
+
+    lines.append("    return obj")
+
+    exec("\n".join(lines), env)
+    return env["hydrate"]
+
+
+@lru_cache(maxsize=None)
+def _dumper(cls) -> Callable:
+    """generated function(object) -> dict of all dataclass fields"""
+    items = ", ".join(f"{i.name!r}: obj.{i.name}" for i in fields(cls))
+
+    env = {}
+    exec(f"def dump(obj):\n    return {{{items}}}", env)
+    return env["dump"]
+
+
+def _hydrate(cls, rows: List) -> List:
+    """objects of records, all rows of one query share the columns"""
+    if not rows:
+        return []
+
+    hydrate = _hydrator(cls, tuple(rows[0].keys()))
+    return [hydrate(i) for i in rows]
+
+
+def _records(cls, rows: List[dict]) -> Tuple[List[str], List[tuple]]:
+    """convert rows into records of all dataclass columns, missing values are filled by field defaults"""
+    cls_fields = fields(cls)
+    names = {i.name for i in cls_fields}
+    columns = [i.name for i in cls_fields]
+
+    records = []
+    for row in rows:
+        for k in row:
+            # reject unknown key
+            if k not in names:
+                raise InvalidParams(msg=f"unknown field: {k}")
+
+        record = []
+        for i in cls_fields:
+            if i.name in row:
+                record.append(row[i.name])
+            elif i.default is not MISSING:
+                record.append(i.default)
+            elif i.default_factory is not MISSING:
+                record.append(i.default_factory())
+            else:
+                raise InvalidParams(msg=f"missing field: {i.name}")
+
+        records.append(tuple(record))
+
+    return columns, records
+
+
+@dataclass(slots=True)
 class BasicFields:
     id: str = field(default_factory=lambda: Xid().string())
     ts_created: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
@@ -26,6 +379,8 @@ class BasicFields:
 
 
 class HasInfoField:
+    __slots__ = ()
+
     info: Dict
 
     def __post_init__(self):
@@ -34,85 +389,307 @@ class HasInfoField:
 
 
 class DumpMethod:
+    __slots__ = ()
+
     def dump(self):
-        return {i.name: getattr(self, i.name) for i in fields(self.__class__)}
+        return _dumper(self.__class__)(self)
 
 
-class GetMethod:
-    @staticmethod
-    async def get(db: Connection, key: str):
-        table, key = _get_table(__class__)
+async def _load(cls, db: Union[Connection, Pool, Cluster], key: str):
+    """get through the model cache, which is skipped by reads inside consistent()
+
+    the cache is filled from the primary only, a lagging replica would keep a stale row cached for ttl
+    """
+    cache = _object_cache(cls)
+
+    row = None
+    if cache is not None and not _consistent.get():
+        row = cache.get(key)
 
-        row = await db.fetchrow(f"select * from {table} where {key}=$1 and not removed", key)
+    if row is None:
+        q = _sql(cls, "get", (), lambda table, k: f"select * from {table} where {k}=$1 and not removed")
+
+        row = await _run(db, "fetchrow", q, key, read=cache is None)
         if not row:
             raise ObjectNotFound()
 
-        return __class__.__new__(**dict(row))
+        if cache is not None:
+            cache.put(key, row)
 
+    return _hydrator(cls, tuple(row.keys()))(row)
 
-class FindMethod:
-    @staticmethod
-    async def find(db: Connection, values: dict, offset: int, limit: int, order: Optional[str] = None) -> List:
-        table, _ = _get_table(__class__)
 
-        if order:
-            o = f"order by {order}"
+class GetMethod:
+    __slots__ = ()
+
+    # read-through cache of get by key, disabled when size is 0. misses are read from the primary of a cluster.
+    # it is local to the process, so updates from other processes are seen after ttl seconds
+    __cache_size__ = 0
+    __cache_ttl__ = 60.0
+
+    @classmethod
+    async def get(cls, db: Connection, key: str):
+        identity = _identity.get()
+        if identity is None:
+            return await _load(cls, db, key)
+
+        k = (cls, key)
+        task = identity.get(k)
+        if task is None:
+            _identity_stats["misses"] += 1
+
+            def forget(task):
+                # failed loads are not kept, the exception is retrieved here
+                if task.cancelled() or task.exception() is not None:
+                    if identity.get(k) is task:
+                        del identity[k]
+
+            task = identity[k] = asyncio.ensure_future(_load(cls, db, key))
+            task.add_done_callback(forget)
         else:
-            o = "order by ts_created,ts_updated"
+            _identity_stats["hits"] += 1
 
-        statement_filter = []
-        for i in values:
-            statement_filter.append(f"{i} = ${len(statement_filter) + 1}")
+        return await asyncio.shield(task)
+
+
+class FindMethod:
+    __slots__ = ()
+
+    @classmethod
+    async def find(cls, db: Connection, values: dict, offset: int, limit: int, order: Optional[str] = None) -> List:
+        columns = tuple(values)
+
+        def build(table, _):
+            if order:
+                o = f"order by {order}"
+            else:
+                o = "order by ts_created,ts_updated"
+
+            n = len(columns)
+            return f"select * from {table} where {_filters(columns)} {o} offset ${n + 1} limit ${n + 2}"
 
-        q = f"select * from {table} where {'and '.join(statement_filter)} {o} offset $2 limit $3"
-        rows = await db.fetchrow(q, *values.values(), offset, limit)
+        q = _sql(cls, "find", (columns, order), build)
+        rows = await _run(db, "fetch", q, *values.values(), offset, limit, read=True)
         if not rows:
             raise ObjectNotFound()
 
-        return [__class__.__new__(**dict(i)) for i in rows]
+        return _hydrate(cls, rows)
+
+    @classmethod
+    async def find_page(
+        cls,
+        db: Connection,
+        values: dict,
+        limit: int,
+        cursor: Optional[str] = None,
+        order: Sequence[str] = ("ts_created",),
+        desc: bool = False,
+    ) -> Tuple[List, Optional[str]]:
+        """keyset pagination, return items and the cursor of next page(None at the last page)
+
+        rows after cursor are located by `(order columns) > (cursor values)` instead of offset,
+        so deep pages cost the same as the first one with an index on the order columns.
+        the cursor is opaque, only pass it back with the same values/order/desc
+        """
+        columns = tuple(values)
+        order = _keyset(cls, order)
+        after = _decode_cursor(cls, order, cursor) if cursor else None
+
+        def build(table, _):
+            n = len(columns)
+            statement_filter = _filters(columns)
+            if after is not None:
+                keys = ",".join(order)
+                params = ",".join(f"${n + i + 1}" for i in range(len(order)))
+                statement_filter += f" and ({keys}) {'<' if desc else '>'} ({params})"
+                n += len(order)
+
+            o = ",".join(f"{i} desc" if desc else i for i in order)
+            return f"select * from {table} where {statement_filter} order by {o} limit ${n + 1}"
+
+        q = _sql(cls, "find_page", (columns, order, desc, after is not None), build)
+        rows = await _run(db, "fetch", q, *values.values(), *(after or ()), limit, read=True)
+
+        items = _hydrate(cls, rows)
+        if len(rows) < limit:
+            return items, None
+
+        return items, _encode_cursor(rows[-1][i] for i in order)
+
+    @classmethod
+    async def iterate(
+        cls,
+        db: Union[Connection, Pool, Cluster],
+        values: dict,
+        order: Optional[str] = None,
+        prefetch: int = 1000,
+    ) -> AsyncIterator:
+        """stream all matched objects by a server side cursor, only prefetch rows are kept in memory
+
+        the cursor lives in a transaction on one connection, which is held until the iteration ends
+        """
+        columns = tuple(values)
+
+        def build(table, _):
+            return f"select * from {table} where {_filters(columns)} order by {order or 'ts_created,ts_updated'}"
+
+        q = _sql(cls, "iterate", (columns, order), build)
+        async with _transaction(db, read=True) as con:
+            hydrate = None
+            async for row in con.cursor(q, *values.values(), prefetch=prefetch):
+                if hydrate is None:
+                    hydrate = _hydrator(cls, tuple(row.keys()))
+
+                yield hydrate(row)
 
 
 class CreateMethod:
-    @staticmethod
-    async def create(db: Connection, values: dict):
-        table, key = _get_table(__class__)
-        cls_fields = fields(__class__)
+    __slots__ = ()
 
-        statement_keys = []
-        statement_values = []
+    @classmethod
+    async def create(cls, db: Connection, values: dict):
+        cls_fields = _field_names(cls)
 
         for i in values:
-            # ignore unknown key
+            # reject unknown key
             if i not in cls_fields:
-                raise InvalidParams(i)
+                raise InvalidParams(msg=f"unknown field: {i}")
 
-            statement_keys.append(i)
-            statement_values.append(f"${len(statement_keys)}")
+        columns = tuple(values)
 
-        q = f"insert into {table}({','.join(statement_keys)}) values({','.join(statement_values)}) on conflict do nothing returing {key}"
-        return await db.fetchval(q, *values.values())
+        def build(table, key):
+            statement_values = [f"${i + 1}" for i in range(len(columns))]
+            return f"insert into {table}({','.join(columns)}) values({','.join(statement_values)}) on conflict do nothing returning {key}"
+
+        q = _sql(cls, "create", columns, build)
+        return await _run(db, "fetchval", q, *values.values())
+
+    @classmethod
+    async def create_many(cls, db: Connection, rows: List[dict], on_conflict: Optional[str] = None, chunk_size: int = 1000) -> List:
+        """insert many rows and return their keys
+
+        every row is checked against the dataclass fields, missing columns are filled by the field defaults,
+        so keys are known before sending.
+        without on_conflict, rows are sent by binary COPY in one round trip;
+        otherwise by chunked multi-row insert with `on conflict {on_conflict}`(e.g. "do nothing"),
+        and only keys of inserted rows are returned
+        """
+        table, key = _get_table(cls)
+        columns, records = _records(cls, rows)
+        if not records:
+            return []
+
+        if on_conflict is None:
+            await db.copy_records_to_table(table, records=records, columns=columns)
+
+            i = columns.index(key)
+            return [r[i] for r in records]
+
+        # postgresql accept 32767 parameters at most
+        chunk_size = max(1, min(chunk_size, 32767 // len(columns)))
+
+        def build(table, key):
+            statement_values = []
+            for n in range(count):
+                offset = n * len(columns)
+                statement_values.append("(" + ",".join(f"${offset + i + 1}" for i in range(len(columns))) + ")")
+
+            return f"insert into {table}({','.join(columns)}) values {','.join(statement_values)} on conflict {on_conflict} returning {key}"
+
+        keys = []
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start : start + chunk_size]
+            count = len(chunk)
+
+            q = _sql(cls, "create_many", (on_conflict, count), build)
+            rows = await _run(db, "fetch", q, *[v for r in chunk for v in r])
+            keys.extend(r[0] for r in rows)
+
+        return keys
 
 
 class UpdateMethod:
+    __slots__ = ()
+
+    def _diff(self, values: dict, names: FrozenSet[str], key: str) -> dict:
+        # ignore unknown key, the primary key and eq old value
+        return {k: v for k, v in values.items() if k in names and k != key and v != getattr(self, k)}
+
     async def update(self, db: Connection, values: dict):
-        table, key = _get_table(self.__class__)
-        cls_fields = fields(self.__class__)
+        """update changed fields by one statement, ts_updated is set to now() when the model has it"""
+        cls = self.__class__
+        _, key = _get_table(cls)
+        names = _field_names(cls)
+
+        updated = self._diff(values, names, key)
+        if not updated:
+            return updated
 
-        updated = {}
+        columns = tuple(updated)
+        touch = "ts_updated" in names and "ts_updated" not in updated
 
-        async with db.transaction():
-            for k, v in values.items():
-                # ignore unknown key
-                if k not in cls_fields:
-                    continue
+        def build(table, key):
+            statement_sets = [f"{k}=${i + 2}" for i, k in enumerate(columns)]
+            if touch:
+                statement_sets.append("ts_updated=now()")
 
-                # ignore eq old value
-                if v == getattr(self, k):
-                    continue
+            return f"update {table} set {','.join(statement_sets)} where {key}=$1 returning {'ts_updated' if touch else key}"
 
-                await db.execute(f"update {table} set {k}=$2 where {key}=$1", k, v)
+        q = _sql(cls, "update", (columns, touch), build)
+        row = await _run(db, "fetchrow", q, getattr(self, key), *updated.values())
+        if not row:
+            raise ObjectNotFound()
+
+        for k, v in updated.items():
+            setattr(self, k, v)
+
+        _invalidate(cls, getattr(self, key), bool(updated.get("removed")))
 
-                setattr(self, k, v)
-                updated[k] = v
+        if touch:
+            self.ts_updated = row[0]
+            updated["ts_updated"] = row[0]
 
         return updated
+
+    @classmethod
+    async def update_many(cls, db: Connection, changes: List[Tuple["UpdateMethod", dict]]) -> List[dict]:
+        """apply per object changes, return updated fields of every object
+
+        objects with the same changed columns share one statement sent by executemany,
+        all statements run in one transaction, ts_updated of the batch is the same client timestamp
+        """
+        _, key = _get_table(cls)
+        names = _field_names(cls)
+        touch = "ts_updated" in names
+        now = datetime.now(timezone.utc)
+
+        results = []
+        groups: Dict[Tuple[str, ...], List[tuple]] = {}
+        for obj, values in changes:
+            updated = obj._diff(values, names, key)
+            if updated and touch and "ts_updated" not in updated:
+                updated["ts_updated"] = now
+
+            results.append(updated)
+            if updated:
+                groups.setdefault(tuple(updated), []).append((getattr(obj, key), *updated.values()))
+
+        if groups:
+            async with _transaction(db) as con:
+                for columns, args in groups.items():
+
+                    def build(table, key):
+                        statement_sets = [f"{k}=${i + 2}" for i, k in enumerate(columns)]
+                        return f"update {table} set {','.join(statement_sets)} where {key}=$1"
+
+                    q = _sql(cls, "update_many", columns, build)
+                    await _run(con, "executemany", q, args)
+
+        for (obj, _), updated in zip(changes, results):
+            for k, v in updated.items():
+                setattr(obj, k, v)
+
+            if updated:
+                _invalidate(cls, getattr(obj, key), bool(updated.get("removed")))
+
+        return results
@@ -0,0 +1,374 @@
+from . import serial
+from .exception import InvalidParams, ObjectNotFound
+from .serial import BasicFields, CreateMethod, DumpMethod, FindMethod, GetMethod, HasInfoField, UpdateMethod
+from .web import conn_init
+import asyncio
+import os
+import time
+import unittest
+from dataclasses import dataclass, fields
+
+from asyncpg import InterfaceError, create_pool
+from xid import Xid
+
+# serial tests need a postgresql, e.g. POSTGRESQL_DSN=postgresql://postgres@/postgres?host=/tmp/pgdata
+DSN = os.environ.get("POSTGRESQL_DSN")
+
+
+@dataclass(slots=True)
+class Item(BasicFields, HasInfoField, DumpMethod, GetMethod, FindMethod, CreateMethod, UpdateMethod):
+    name: str = ""
+    count: int = 0
+
+    __table_name__ = "test_serial_item"
+
+
+@dataclass(slots=True)
+class CachedItem(Item):
+    __cache_size__ = 2
+    __cache_ttl__ = 60.0
+
+
+class TestHydrate(unittest.TestCase):
+    def test_hydrate(self):
+        columns = ("count", "name", "info", "id", "extra")
+        item = serial._hydrator(Item, columns)((3, "a", '{"k": 1}', "key", None))
+
+        self.assertIsInstance(item, Item)
+        self.assertFalse(hasattr(item, "__dict__"))
+        self.assertEqual((item.id, item.name, item.count, item.info, item.removed), ("key", "a", 3, {"k": 1}, False))
+        self.assertIsNotNone(item.ts_created)
+
+        self.assertIs(serial._hydrator(Item, columns), serial._hydrator(Item, columns))
+        self.assertEqual(item.dump(), {f: getattr(item, f) for f in ("id", "ts_created", "ts_updated", "removed", "info", "name", "count")})
+        self.assertEqual(item, Item(id="key", ts_created=item.ts_created, ts_updated=item.ts_updated, info={"k": 1}, name="a", count=3))
+
+    def test_post_init(self):
+        @dataclass
+        class Checked(Item):
+            def __post_init__(self):
+                super(Checked, self).__post_init__()
+                self.name = self.name.upper()
+
+        item = serial._hydrator(Checked, ("id", "name", "info"))(("key", "a", "{}"))
+        self.assertEqual((item.name, item.info), ("A", {}))
+
+
+@unittest.skipUnless(DSN, "POSTGRESQL_DSN not set")
+class TestSerial(unittest.TestCase):
+    def run_db(self, test):
+        async def run():
+            pool = await create_pool(
+                dsn=DSN,
+                min_size=1,
+                max_size=4,
+                init=conn_init,
+                statement_cache_size=serial.statement_cache_size,
+                max_cacheable_statement_size=serial.max_cacheable_statement_size,
+                max_cached_statement_lifetime=serial.max_cached_statement_lifetime,
+            )
+            try:
+                await pool.execute(f"drop table if exists {Item.__table_name__}")
+                await pool.execute(
+                    f"""create table {Item.__table_name__}(
+                        id text primary key,
+                        ts_created timestamptz not null default now(),
+                        ts_updated timestamptz not null default now(),
+                        removed boolean not null default false,
+                        info jsonb not null default '{{}}',
+                        name text not null default '',
+                        count integer not null default 0
+                    )"""
+                )
+                return await test(pool)
+            finally:
+                await pool.execute(f"drop table if exists {Item.__table_name__}")
+                await pool.close()
+
+        return asyncio.run(run())
+
+    def test_create_many(self):
+        async def test(db):
+            keys = await Item.create_many(db, [{"name": "a", "count": 1}, {"name": "b", "info": {"k": "v"}}])
+            self.assertEqual(len(keys), 2)
+
+            rows = await db.fetch(f"select * from {Item.__table_name__} order by name")
+            self.assertEqual([r["id"] for r in rows], keys)
+            self.assertEqual(rows[1]["info"], {"k": "v"})
+
+            # conflict rows are skipped
+            inserted = await Item.create_many(db, [{"id": keys[0], "name": "c"}, {"name": "d"}], on_conflict="do nothing", chunk_size=1)
+            self.assertEqual(len(inserted), 1)
+            self.assertNotIn(keys[0], inserted)
+            self.assertEqual(await db.fetchval(f"select count(*) from {Item.__table_name__}"), 3)
+
+            with self.assertRaises(InvalidParams):
+                await Item.create_many(db, [{"unknown": 1}])
+
+        self.run_db(test)
+
+    def test_update(self):
+        async def test(db):
+            keys = await Item.create_many(db, [{"name": "a"}, {"name": "b"}, {"name": "c"}])
+            items = [Item(**dict(r)) for r in await db.fetch(f"select * from {Item.__table_name__} order by name")]
+
+            item = items[0]
+            ts_updated = item.ts_updated
+            updated = await item.update(db, {"name": "a2", "count": 0, "unknown": 1, "info": {"k": 1}})
+            self.assertEqual(set(updated), {"name", "info", "ts_updated"})
+            self.assertGreater(item.ts_updated, ts_updated)
+
+            row = await db.fetchrow(f"select * from {Item.__table_name__} where id=$1", keys[0])
+            self.assertEqual((row["name"], row["info"], row["ts_updated"]), ("a2", {"k": 1}, item.ts_updated))
+
+            self.assertEqual(await item.update(db, {"name": "a2"}), {})
+
+            results = await Item.update_many(db, [(items[0], {"count": 1}), (items[1], {"count": 2}), (items[2], {"name": "c2", "count": 3})])
+            self.assertEqual([set(i) for i in results], [{"count", "ts_updated"}, {"count", "ts_updated"}, {"name", "count", "ts_updated"}])
+
+            rows = await db.fetch(f"select * from {Item.__table_name__} order by name")
+            self.assertEqual([(r["name"], r["count"]) for r in rows], [("a2", 1), ("b", 2), ("c2", 3)])
+            self.assertEqual([i.count for i in items], [1, 2, 3])
+
+            missing = Item(name="x")
+            with self.assertRaises(ObjectNotFound):
+                await missing.update(db, {"name": "y"})
+
+        self.run_db(test)
+
+    def test_get_find(self):
+        async def test(db):
+            keys = await Item.create_many(db, [{"name": "a", "count": 1}, {"name": "b", "count": 1}, {"name": "c", "count": 2}])
+
+            # sql of other tests may be cached
+            serial._sql_cache.clear()
+            sql = serial.stats()["sql"]
+            prepared = serial.stats()["prepared"]
+
+            for _ in range(3):
+                item = await Item.get(db, keys[1])
+                self.assertIsInstance(item, Item)
+                self.assertEqual(item.name, "b")
+
+                items = await Item.find(db, {"count": 1}, 0, 10, order="name desc")
+                self.assertEqual([i.name for i in items], ["b", "a"])
+
+            self.assertEqual([i.name for i in await Item.find(db, {}, 1, 1)], ["b"])
+
+            with self.assertRaises(ObjectNotFound):
+                await Item.get(db, "missing")
+
+            self.assertIsNotNone(await Item.create(db, {"id": Xid().string(), "name": "d"}))
+
+            # sql text is built once, statements are prepared once per connection by asyncpg
+            stats = serial.stats()
+            self.assertEqual(stats["sql"]["misses"] - sql["misses"], 4)
+            self.assertEqual(stats["sql"]["hits"] - sql["hits"], 5)
+            self.assertGreaterEqual(stats["prepared"]["hits"] - prepared["hits"], 4)
+            self.assertLessEqual(stats["prepared"]["misses"] - prepared["misses"], 4 * stats["prepared"]["connections"])
+
+            # over max_cacheable_statement_size, not cached by asyncpg and not counted
+            prepared = serial.stats()["prepared"]
+            await Item.create_many(db, [{"name": f"big-{i}"} for i in range(500)], on_conflict="do nothing")
+            self.assertEqual(serial.stats()["prepared"], prepared)
+
+        self.run_db(test)
+
+    def test_find_page(self):
+        async def test(db):
+            keys = await Item.create_many(db, [{"name": f"item-{i:02}", "count": i % 2} for i in range(25)])
+
+            for order, desc in [(("ts_created",), False), (("name",), True), (("count", "name"), False)]:
+                seen, cursor = [], None
+                while True:
+                    items, cursor = await Item.find_page(db, {}, 10, cursor=cursor, order=order, desc=desc)
+                    seen.extend(items)
+                    if cursor is None:
+                        break
+
+                self.assertEqual(len(seen), 25)
+                self.assertEqual({i.id for i in seen}, set(keys))
+
+                expected = sorted(seen, key=lambda i: tuple(getattr(i, k) for k in (*order, "id")), reverse=desc)
+                self.assertEqual([i.id for i in seen], [i.id for i in expected])
+
+            items, cursor = await Item.find_page(db, {"count": 1}, 100)
+            self.assertEqual(len(items), 12)
+            self.assertIsNone(cursor)
+
+            with self.assertRaises(InvalidParams):
+                await Item.find_page(db, {}, 10, cursor="bad")
+
+            with self.assertRaises(InvalidParams):
+                await Item.find_page(db, {}, 10, order=("unknown",))
+
+        self.run_db(test)
+
+    def test_iterate(self):
+        async def test(db):
+            await Item.create_many(db, [{"name": f"item-{i:04}", "count": i % 3} for i in range(2500)])
+
+            names = [i.name async for i in Item.iterate(db, {}, order="name", prefetch=100)]
+            self.assertEqual(names, [f"item-{i:04}" for i in range(2500)])
+
+            count = 0
+            async for item in Item.iterate(db, {"count": 0}):
+                self.assertIsInstance(item, Item)
+                count += 1
+            self.assertEqual(count, 834)
+
+        self.run_db(test)
+
+    def test_create_many_benchmark(self):
+        count = 20000
+
+        async def test(db):
+            rows = [{"name": f"item-{i}", "count": i} for i in range(count)]
+
+            start = time.perf_counter()
+            async with db.acquire() as con:
+                for row in rows[:2000]:
+                    await Item.create(con, {"id": Xid().string(), **row})
+            single = 2000 / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await Item.create_many(db, rows)
+            copy = count / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await Item.create_many(db, rows, on_conflict="do nothing")
+            values = count / (time.perf_counter() - start)
+
+            print(f"\ncreate: {single:.0f} rows/s, create_many copy: {copy:.0f} rows/s, multi-row values: {values:.0f} rows/s")
+            self.assertEqual(await db.fetchval(f"select count(*) from {Item.__table_name__}"), 2000 + count * 2)
+            self.assertGreater(copy, single)
+
+        self.run_db(test)
+
+    def test_hydrate_benchmark(self):
+        count = 20000
+
+        async def test(db):
+            await Item.create_many(db, [{"name": f"item-{i}", "count": i, "info": {"i": i}} for i in range(count)])
+            rows = await db.fetch(f"select * from {Item.__table_name__}")
+
+            start = time.perf_counter()
+            for row in rows:
+                item = Item(**dict(row))
+                {f.name: getattr(item, f.name) for f in fields(Item)}
+            plain = count / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for item in serial._hydrate(Item, rows):
+                item.dump()
+            generated = count / (time.perf_counter() - start)
+
+            print(f"\nhydrate+dump: kwargs {plain:.0f} rows/s, generated {generated:.0f} rows/s")
+            self.assertEqual([i.dump() for i in serial._hydrate(Item, rows[:10])], [Item(**dict(r)).dump() for r in rows[:10]])
+
+        self.run_db(test)
+
+    def test_cluster(self):
+        async def test(db):
+            replicas = [await create_pool(dsn=DSN, min_size=1, max_size=2, init=conn_init) for _ in range(2)]
+            cluster = serial.Cluster(db, replicas)
+            try:
+                self.assertEqual([cluster.reader() for _ in range(4)], replicas * 2)
+
+                with serial.consistent():
+                    self.assertIs(cluster.reader(), db)
+                self.assertIn(cluster.reader(), replicas)
+
+                # writes go to the primary, pool methods are delegated to it
+                keys = await Item.create_many(cluster, [{"name": "a"}, {"name": "b"}])
+                self.assertEqual(await cluster.fetchval(f"select count(*) from {Item.__table_name__}"), 2)
+
+                item = await Item.get(cluster, keys[0])
+                await item.update(cluster, {"name": "a2"})
+                with serial.consistent():
+                    self.assertEqual((await Item.get(cluster, keys[0])).name, "a2")
+
+                self.assertEqual(len(await Item.find(cluster, {}, 0, 10)), 2)
+                self.assertEqual(len([i async for i in Item.iterate(cluster, {})]), 2)
+
+                # the model cache is filled from the primary, never from a replica
+                broken = await create_pool(dsn=DSN, min_size=0, max_size=1, init=conn_init)
+                await broken.close()
+                stale = serial.Cluster(db, [broken])
+                with self.assertRaises(InterfaceError):
+                    await Item.get(stale, keys[0])
+                self.assertEqual((await CachedItem.get(stale, keys[0])).name, "a2")
+
+                # least busy skips the replica holding connections
+                cluster = serial.Cluster(db, replicas, select="least_busy")
+                async with replicas[0].acquire():
+                    self.assertEqual({cluster.reader() for _ in range(4)}, {replicas[1]})
+
+                await cluster.warmup(2)
+                self.assertEqual([(i["role"], i["size"]) for i in cluster.stats()], [("primary", 2), ("replica", 2), ("replica", 2)])
+
+                with self.assertRaises(InvalidParams):
+                    serial.Cluster(db, replicas, select="random")
+            finally:
+                await asyncio.gather(*[p.close() for p in replicas])
+
+        self.run_db(test)
+
+    def test_cache(self):
+        async def test(db):
+            keys = await CachedItem.create_many(db, [{"name": "a"}, {"name": "b"}, {"name": "c"}])
+
+            async with db.acquire() as con:
+                queries = []
+                con.add_query_logger(lambda r: r.query.startswith("select") and queries.append(r.query))
+
+                async def selects():
+                    # query loggers are called soon
+                    await asyncio.sleep(0)
+                    return len(queries)
+
+                a = await CachedItem.get(con, keys[0])
+                self.assertEqual((await CachedItem.get(con, keys[0])).name, "a")
+                self.assertIsNot(await CachedItem.get(con, keys[0]), a)
+                self.assertEqual(await selects(), 1)
+
+                # invalidated by update
+                await a.update(con, {"name": "a2"})
+                self.assertEqual((await CachedItem.get(con, keys[0])).name, "a2")
+                self.assertEqual(await selects(), 2)
+
+                # consistent reads skip the cache
+                with serial.consistent():
+                    await CachedItem.get(con, keys[0])
+                self.assertEqual(await selects(), 3)
+
+                # soft deleted objects are not found
+                await a.update(con, {"removed": True})
+                with self.assertRaises(ObjectNotFound):
+                    await CachedItem.get(con, keys[0])
+                self.assertEqual(await selects(), 4)
+
+                # same object inside an identity map, concurrent gets share one load
+                with serial.identity_map():
+                    b, b2 = await asyncio.gather(CachedItem.get(con, keys[1]), CachedItem.get(con, keys[1]))
+                    self.assertIs(b, b2)
+                    self.assertIs(await CachedItem.get(con, keys[1]), b)
+                    self.assertEqual(await selects(), 5)
+
+                    # failed loads are retried
+                    for _ in range(2):
+                        with self.assertRaises(ObjectNotFound):
+                            await CachedItem.get(con, "missing")
+                    self.assertEqual(await selects(), 7)
+
+                    await CachedItem.update_many(con, [(b, {"removed": True})])
+                    with self.assertRaises(ObjectNotFound):
+                        await CachedItem.get(con, keys[1])
+                    self.assertEqual(await selects(), 8)
+
+            stats = serial.stats()
+            self.assertEqual(stats["objects"]["CachedItem"]["size"], 2)
+            self.assertGreaterEqual(stats["objects"]["CachedItem"]["hits"], 2)
+            self.assertGreaterEqual(stats["identity"]["hits"], 2)
+
+        self.run_db(test)
@@ -1,9 +1,19 @@
+import asyncio
+import hashlib
 import math
 import os
-from typing import Optional
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Hashable, Mapping, Optional, Union
 
-from aiofile import async_open
-from aiohttp import ClientSession, ClientTimeout
+import orjson as json
+from aiofile import AIOFile, async_open
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+
+# application scoped http client, created by setup_session and closed by close_session
+session: Optional[ClientSession] = None
 
 
 def pretty_size(size_bytes):
@@ -17,6 +27,77 @@ def pretty_size(size_bytes):
     return "%s %s" % (s, size_name[i])
 
 
+class LRUCache(object):
+    """size bounded lru cache with hit/miss/eviction counters, None value is not cacheable
+
+    with ttl(seconds), items expire ttl after put, an expired item is dropped by get and counted as a miss
+    """
+
+    def __init__(self, size: int, ttl: float = 0):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key: Hashable) -> Any:
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        if self.ttl > 0:
+            deadline, value = value
+            if deadline < time.monotonic():
+                del self.items[key]
+                self.misses += 1
+                self.expirations += 1
+                return None
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.ttl > 0:
+            value = (time.monotonic() + self.ttl, value)
+
+        self.items[key] = value
+        self.items.move_to_end(key)
+
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> Any:
+        value = self.items.pop(key, None)
+        if value is not None and self.ttl > 0:
+            value = value[1]
+        return value
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self) -> dict:
+        stats = {
+            "size": self.size,
+            "items": len(self.items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+        if self.ttl > 0:
+            stats["ttl"] = self.ttl
+            stats["expirations"] = self.expirations
+        return stats
+
+
 def setup_autoreload(app):
     BLACK_LIST = ["data", "log"]
     WHITE_LIST = [".py", ".ini"]
@@ -62,29 +143,284 @@ def setup_autoreload(app):
         pass
 
 
-async def download(url: str, headers: dict = None, timeout: int = 10) -> bytes:
+def create_session(
+    limit: int = 100,
+    limit_per_host: int = 16,
+    keepalive_timeout: float = 30,
+    ttl_dns_cache: int = 300,
+    **kwargs,
+) -> ClientSession:
+    """create a ClientSession with a tuned pooling connector(per-host limit, keep-alive, dns cache)"""
+    connector = TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=ttl_dns_cache,
+        use_dns_cache=ttl_dns_cache > 0,
+    )
+    return ClientSession(connector=connector, **kwargs)
+
+
+async def setup_session(**kwargs) -> ClientSession:
+    """create the shared session used by download helpers, kwargs see create_session"""
+    global session
+
+    await close_session()
+    session = create_session(**kwargs)
+    return session
+
+
+async def close_session():
+    global session
+
+    if session is not None:
+        s, session = session, None
+        await s.close()
+
+
+@asynccontextmanager
+async def client_session(s: Optional[ClientSession] = None) -> AsyncIterator[ClientSession]:
+    """use explicit session, then the shared one, otherwise a temporary session for this call"""
+    if s is None:
+        s = session
+
+    if s is not None and not s.closed:
+        yield s
+        return
+
+    async with ClientSession() as s:
+        yield s
+
+
+async def download(url: str, headers: dict = None, timeout: int = 10, session: Optional[ClientSession] = None) -> bytes:
     """
     download content and return bytes
     """
 
-    async with ClientSession(headers=headers, timeout=ClientTimeout(total=timeout)) as session:
-        async with session.get(url) as resp:
+    async with client_session(session) as s:
+        async with s.get(url, headers=headers, timeout=ClientTimeout(total=timeout)) as resp:
             return await resp.read()
 
 
-async def download_to_path(url: str, path: str, headers: dict = None, timeout: int = 10, limit: Optional[int] = None) -> bytes:
+class CRC32(object):
+    """hashlib style crc32"""
+
+    name = "crc32"
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data: bytes):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self) -> bytes:
+        return self.value.to_bytes(4, "big")
+
+    def hexdigest(self) -> str:
+        return "%08x" % self.value
+
+
+def new_hasher(name: str):
+    """hashlib object by name, crc32 is supported too"""
+    if name.lower() == "crc32":
+        return CRC32()
+
+    return hashlib.new(name)
+
+
+async def download_to_path(
+    url: str,
+    path: str,
+    headers: dict = None,
+    timeout: int = 10,
+    limit: Optional[int] = None,
+    session: Optional[ClientSession] = None,
+    segments: int = 1,
+    retries: int = 0,
+    digest: Union[str, Any, None] = None,
+    checksum: Optional[str] = None,
+) -> Optional[Mapping]:
     """
-    download content and return bytes
+    download content to path and return response headers(case-insensitive)
+
+    content is written to `path.part` and renamed to path on success, so path is never half written.
+    return None and keep path untouched when server reply 304 not modified(conditional request headers)
+
+    segments > 1 download concurrent byte ranges into a preallocated file when server accept ranges,
+    every range retries `retries` times from where it stopped, progress is kept in `path.part.progress`
+    so calling again after a failure resumes the partial file, timeout is per request
+
+    digest is a hash name(sha256/md5/crc32) or a hashlib style object updated chunk by chunk while streaming,
+    read the result from the object after return. checksum is the expected hex digest(default sha256),
+    on mismatch the partial file is removed and ValueError raised.
+    segmented download can only hash after all ranges are written, that is one more pass over the file
     """
     size = 0
+    path_part = path + ".part"
+
+    hasher = digest
+    if hasher is None and checksum is not None:
+        hasher = "sha256"
+    if isinstance(hasher, str):
+        hasher = new_hasher(hasher)
+
+    async with client_session(session) as s:
+        if segments > 1:
+            async with s.head(url, headers=headers, timeout=ClientTimeout(total=timeout), allow_redirects=True) as resp:
+                if resp.status == 304:
+                    return None
+
+                resp.raise_for_status()
+                resp_headers = resp.headers.copy()
+
+            size = int(resp_headers.get("Content-Length", 0))
+            if limit is not None and size > limit:
+                raise ValueError(f"content size is too big: {pretty_size(size)}")
+
+            if size > 0 and resp_headers.get("Accept-Ranges") == "bytes":
+                validator = resp_headers.get("ETag") or resp_headers.get("Last-Modified") or ""
+                await _download_ranges(s, url, path_part, headers, timeout, size, validator, segments, retries)
+
+                if hasher is not None:
+                    await asyncio.get_running_loop().run_in_executor(None, _hash_file, hasher, path_part)
+
+                _verify(hasher, checksum, path_part)
+                os.replace(path_part, path)
+                return resp_headers
+
+            # ranges are not supported, download serially
+            size = 0
+
+        async with s.get(url, headers=headers, timeout=ClientTimeout(total=timeout)) as resp:
+            if resp.status == 304:
+                return None
+
+            resp.raise_for_status()
+
+            if limit is not None and resp.content_length is not None and resp.content_length > limit:
+                raise ValueError(f"content size is too big: {pretty_size(resp.content_length)}")
+
+            try:
+                async with async_open(path_part, "wb+") as f:
+                    async for data in resp.content.iter_chunked(2 << 19):  # 1mb
+                        size += len(data)
+
+                        if limit is not None and size > limit:
+                            raise ValueError(f"content size is too big: {pretty_size(size)}")
+
+                        if hasher is not None:
+                            hasher.update(data)
+
+                        await f.write(data)
+
+                _verify(hasher, checksum, path_part)
+            except BaseException:
+                if os.path.isfile(path_part):
+                    os.remove(path_part)
+                raise
+
+            os.replace(path_part, path)
+            return resp.headers.copy()
 
-    async with ClientSession(headers=headers, timeout=ClientTimeout(timeout)) as session:
-        async with session.get(url) as resp:
-            async with async_open(path, "wb+") as f:
-                async for data in resp.content.iter_chunked(2 << 19):  # 1mb
-                    size += len(data)
 
-                    if limit is not None and size > limit:
-                        raise ValueError(f"content size is too big: {pretty_size(size)}")
+def _hash_file(hasher, path: str):
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(2 << 19), b""):
+            hasher.update(data)
+
+
+def _verify(hasher, checksum: Optional[str], path: str):
+    """remove path and raise ValueError when digest is not checksum"""
+    if checksum is None or hasher.hexdigest() == checksum.lower():
+        return
+
+    for i in [path, path + ".progress"]:
+        if os.path.isfile(i):
+            os.remove(i)
+
+    raise ValueError(f"checksum mismatch: {hasher.name} {hasher.hexdigest()} != {checksum}")
+
+
+async def _download_ranges(
+    s: ClientSession,
+    url: str,
+    path: str,
+    headers: Optional[dict],
+    timeout: int,
+    size: int,
+    validator: str,
+    segments: int,
+    retries: int,
+):
+    """download [0, size) by concurrent range requests, write every range at its offset"""
+    path_progress = path + ".progress"
+
+    step = -(-size // segments)
+    ranges = [(i, min(i + step, size) - 1) for i in range(0, size, step)]
+
+    # downloaded bytes of every range, resume when the partial file is the same content
+    done = [0] * len(ranges)
+    try:
+        with open(path_progress, "r") as f:
+            progress = json.loads(f.read())
+        if progress["size"] == size and progress["validator"] == validator and len(progress["done"]) == len(ranges):
+            if os.path.isfile(path) and os.path.getsize(path) == size:
+                done = progress["done"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    if not any(done):
+        # preallocate
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+    # conditional headers are replaced by If-Range, a changed content will be a full 200 response
+    headers = {k: v for k, v in (headers or {}).items() if k.lower() not in ("if-none-match", "if-modified-since", "range")}
+    if validator:
+        headers["If-Range"] = validator
+
+    async def fetch(f: AIOFile, i: int):
+        start, end = ranges[i]
+
+        for retry in range(retries + 1):
+            pos = start + done[i]
+            if pos > end:
+                return
+
+            try:
+                async with s.get(url, headers={**headers, "Range": f"bytes={pos}-{end}"}, timeout=ClientTimeout(total=timeout)) as resp:
+                    if resp.status != 206:
+                        raise ValueError(f"range request failed: {resp.status} {resp.reason}")
+
+                    async for data in resp.content.iter_chunked(2 << 19):  # 1mb
+                        if pos + len(data) > end + 1:
+                            raise ValueError(f"range overflow: bytes={pos}-{end}")
+
+                        await f.write(data, offset=pos)
+                        pos += len(data)
+                        done[i] += len(data)
+
+                if pos <= end:
+                    raise ValueError(f"range truncated: bytes={pos}-{end}")
+                return
+            except (ClientError, asyncio.TimeoutError, ValueError):
+                if retry >= retries:
+                    raise
+
+    completed = False
+    try:
+        async with AIOFile(path, "r+b") as f:
+            # let every range finish or fail on its own, so the progress is exact
+            results = await asyncio.gather(*[fetch(f, i) for i in range(len(ranges))], return_exceptions=True)
 
-                    await f.write(data)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        completed = True
+    finally:
+        if completed:
+            if os.path.isfile(path_progress):
+                os.remove(path_progress)
+        else:
+            with open(path_progress, "w") as f:
+                f.write(json.dumps({"size": size, "validator": validator, "done": done}).decode())
@@ -0,0 +1,206 @@
+from . import utils
+from .utils import CRC32, LRUCache, close_session, download, download_to_path, setup_session
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+import zlib
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+
+class Server(object):
+    """local aiohttp stand-in server, records remote ports of requests"""
+
+    def __init__(self, routes):
+        self.app = web.Application()
+        self.app.router.add_routes(routes)
+        self.peers = []
+
+        @web.middleware
+        async def record(request, handler):
+            self.peers.append(request.transport.get_extra_info("peername")[1])
+            return await handler(request)
+
+        self.app.middlewares.append(record)
+
+    async def __aenter__(self):
+        self.server = TestServer(self.app, host="127.0.0.1")
+        await self.server.start_server()
+        self.url = str(self.server.make_url("")).rstrip("/")
+        return self
+
+    async def __aexit__(self, *args):
+        await self.server.close()
+
+
+class TestSession(unittest.TestCase):
+    def test_shared_session(self):
+        async def hello(request):
+            return web.Response(body=b"hello")
+
+        async def run():
+            async with Server([web.get("/", hello)]) as server:
+                # temporary session per call
+                self.assertEqual(await download(server.url), b"hello")
+                self.assertEqual(await download(server.url), b"hello")
+                self.assertNotEqual(server.peers[0], server.peers[1])
+
+                # shared keep-alive connection
+                s = await setup_session(limit_per_host=1)
+                self.assertIs(utils.session, s)
+                self.assertEqual(await download(server.url), b"hello")
+                self.assertEqual(await download(server.url), b"hello")
+                self.assertEqual(server.peers[2], server.peers[3])
+
+                await close_session()
+                self.assertIsNone(utils.session)
+                self.assertTrue(s.closed)
+
+        asyncio.run(run())
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_lru(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats(), {"size": 2, "items": 2, "hits": 2, "misses": 1, "evictions": 1})
+
+    def test_ttl(self):
+        cache = LRUCache(2, ttl=0.05)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.pop("a"), 1)
+
+        cache.put("b", 2)
+        time.sleep(0.06)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats(), {"size": 2, "items": 0, "hits": 1, "misses": 1, "evictions": 0, "ttl": 0.05, "expirations": 1})
+
+
+class TestDownloadRanges(unittest.TestCase):
+    CONTENT = bytes(range(256)) * 4099  # ~1mb, not aligned to segments
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "content.bin")
+
+        self.ranges = []
+        self.fail = set()  # range starts which break in the middle once
+        self.accept_ranges = True
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def handler(self, request):
+        content = self.CONTENT
+        headers = {"ETag": '"v1"'}
+        if self.accept_ranges:
+            headers["Accept-Ranges"] = "bytes"
+
+        if request.method == "HEAD" or "Range" not in request.headers or not self.accept_ranges:
+            headers["Content-Length"] = str(len(content))
+            return web.Response(body=None if request.method == "HEAD" else content, headers=headers)
+
+        start, end = [int(i) for i in request.headers["Range"][len("bytes=") :].split("-")]
+        self.ranges.append((start, end))
+
+        resp = web.StreamResponse(status=206, headers=headers)
+        resp.content_length = end - start + 1
+        await resp.prepare(request)
+
+        if start in self.fail:
+            self.fail.remove(start)
+            await resp.write(content[start : start + (end - start) // 2])
+            raise ConnectionResetError("broken range")
+
+        await resp.write(content[start : end + 1])
+        return resp
+
+    def download(self, **kwargs):
+        async def run():
+            async with Server([web.get("/content.bin", self.handler)]) as server:
+                return await download_to_path(server.url + "/content.bin", self.path, **kwargs)
+
+        return asyncio.run(run())
+
+    def assertContent(self):
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.CONTENT)
+        self.assertFalse(os.path.exists(self.path + ".part"))
+        self.assertFalse(os.path.exists(self.path + ".part.progress"))
+
+    def test_segments(self):
+        headers = self.download(segments=4)
+        self.assertEqual(headers["ETag"], '"v1"')
+        self.assertEqual(len(self.ranges), 4)
+        self.assertEqual(self.ranges[-1][1], len(self.CONTENT) - 1)
+        self.assertContent()
+
+    def test_retry(self):
+        self.fail.add(0)
+        self.download(segments=4, retries=1)
+        self.assertEqual(len(self.ranges), 5)
+        self.assertGreater(self.ranges[-1][0], 0)
+        self.assertContent()
+
+    def test_resume(self):
+        step = -(-len(self.CONTENT) // 3)
+        self.fail.add(step)
+
+        with self.assertRaises(Exception):
+            self.download(segments=3)
+        self.assertTrue(os.path.exists(self.path + ".part.progress"))
+        self.assertFalse(os.path.exists(self.path))
+
+        # only the rest of the broken range is downloaded again
+        self.ranges.clear()
+        self.download(segments=3)
+        self.assertEqual(len(self.ranges), 1)
+        self.assertGreater(self.ranges[0][0], step)
+        self.assertContent()
+
+    def test_limit(self):
+        with self.assertRaises(ValueError):
+            self.download(segments=4, limit=1024)
+        self.assertEqual(self.ranges, [])
+
+    def test_no_ranges(self):
+        self.accept_ranges = False
+        self.download(segments=4)
+        self.assertEqual(self.ranges, [])
+        self.assertContent()
+
+    def test_checksum(self):
+        expected = hashlib.sha256(self.CONTENT).hexdigest()
+
+        for segments in [1, 4]:
+            hasher = hashlib.md5()
+            self.download(segments=segments, digest=hasher)
+            self.assertEqual(hasher.hexdigest(), hashlib.md5(self.CONTENT).hexdigest())
+            self.assertContent()
+            os.remove(self.path)
+
+            self.download(segments=segments, checksum=expected)
+            self.assertContent()
+            os.remove(self.path)
+
+            crc = CRC32()
+            self.download(segments=segments, digest=crc, checksum="%08x" % zlib.crc32(self.CONTENT))
+            self.assertContent()
+
+            # a mismatch keep the old file and remove the partial one
+            with self.assertRaises(ValueError):
+                self.download(segments=segments, checksum="0" * 64)
+            self.assertContent()
+            os.remove(self.path)
@@ -2,18 +2,19 @@ import asyncio
 from core import exception
 from core.exception import ErrorBasic, InvalidParams
 import configparser
+import os
 import signal
+import time
 from decimal import Decimal
-from typing import Any, Optional
+from typing import Any, List, Optional, Tuple, Union
 
 from aiohttp import web
-import asyncpg.pool
 import orjson as json
 from asyncpg import create_pool
 
-from . import ipgeo
+from . import ipgeo, metrics, prefork, serial, utils
 from .config import load_config
-from .log import access, info, error, warning, exception, debug
+from .log import access, access_log, info, error, warning, exception, debug
 
 try:
     import uvloop
@@ -23,14 +24,38 @@ except ImportError:
     pass
 
 
+# dataclass/datetime/uuid/numpy are serialized by orjson natively
+JSON_OPTIONS = json.OPT_SERIALIZE_NUMPY
+
+# pre-encoded sub-document, returned by handlers or embedded in a response(orjson>=3.9)
+Fragment = getattr(json, "Fragment", None)
+
+# type -> dump method of the type, None if it has no dump
+_dump_methods: dict = {}
+
+
 def _custom_json_dump(obj):
-    if hasattr(obj, "dump"):
-        return obj.dump()
+    cls = obj.__class__
+    try:
+        dump = _dump_methods[cls]
+    except KeyError:
+        dump = _dump_methods[cls] = getattr(cls, "dump", None)
+
+    if dump is not None:
+        return dump(obj)
 
     elif isinstance(obj, Decimal):
         return float(obj)
 
 
+def dumps(obj) -> bytes:
+    """json bytes of a response, dicts with non str keys take the slower second pass"""
+    try:
+        return json.dumps(obj, default=_custom_json_dump, option=JSON_OPTIONS)
+    except json.JSONEncodeError:
+        return json.dumps(obj, default=_custom_json_dump, option=JSON_OPTIONS | json.OPT_NON_STR_KEYS)
+
+
 class BasicHandler(web.View):
     user: Any = None
 
@@ -44,7 +69,7 @@ class BasicHandler(web.View):
         return get_info(self.request)
 
     @property
-    def db(self) -> Optional[asyncpg.pool.Pool]:
+    def db(self) -> Optional[serial.Cluster]:
         return self.request.db
 
     @property
@@ -60,6 +85,104 @@ class BasicHandler(web.View):
         return self.request.app.config
 
 
+async def conn_init(con):
+    # binary jsonb(version byte + json text), orjson bytes are sent as is and binary COPY works
+    await con.set_type_codec(
+        "jsonb",
+        schema="pg_catalog",
+        encoder=lambda x: b"\x01" + json.dumps(x),
+        decoder=lambda x: json.loads(x[1:]),
+        format="binary",
+    )
+
+
+# bodies larger than it are read into one preallocated buffer instead of joined chunks
+json_stream_size = 1024 * 1024
+
+
+class Request(web.Request):
+    """request with lazy json body, data and params are parsed from json_body on the first access"""
+
+    ATTRS = web.Request.ATTRS | frozenset(["i", "e", "w", "d", "x", "get_info", "db", "json_body", "_data", "_params"])
+
+    json_body: Optional[Union[bytes, bytearray]] = None
+
+    _data: Optional[dict] = None
+    _params: Optional[dict] = None
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            body = self.json_body
+            if body is None:
+                self._data = {}
+            elif body:
+                start = time.perf_counter()
+                try:
+                    self._data = json.loads(body)
+                except json.JSONDecodeError:
+                    raise InvalidParams(msg="invalid json body")
+
+                if metrics.enabled:
+                    metrics.body["parse"].observe(time.perf_counter() - start)
+            else:
+                self._data = {"params": {}}
+
+        return self._data
+
+    @data.setter
+    def data(self, value: dict):
+        self._data = value
+
+    @property
+    def params(self) -> dict:
+        if self._params is None:
+            data = self.data
+            self._params = data.get("params", {}) if isinstance(data, dict) else {}
+
+        return self._params
+
+    @params.setter
+    def params(self, value: dict):
+        self._params = value
+
+    async def read(self) -> bytes:
+        # a large body streamed by read_body consumed the payload, copy it for read/text/json only when asked
+        if self._read_bytes is None and self.json_body is not None:
+            self._read_bytes = bytes(self.json_body)
+
+        return await super().read()
+
+
+async def read_body(request: web.Request) -> Union[bytes, bytearray]:
+    """body bytes, large body with content length is streamed into one buffer without the extra join copy
+
+    only a Request is streamed, its read() returns the streamed body after json_body is set
+    """
+    length = request.content_length
+    if length is None or length < json_stream_size or not isinstance(request, Request):
+        return await request.read()
+
+    limit = getattr(request.app, "client_max_size", 0)
+    if limit and length > limit:
+        raise web.HTTPRequestEntityTooLarge(max_size=limit, actual_size=length)
+
+    body = bytearray(length)
+    view = memoryview(body)
+    n = 0
+    async for chunk in request.content.iter_any():
+        if n + len(chunk) > length:
+            raise web.HTTPBadRequest(text="body longer than content length")
+
+        view[n : n + len(chunk)] = chunk
+        n += len(chunk)
+
+    if n != length:
+        raise web.HTTPBadRequest(text="body shorter than content length")
+
+    return body
+
+
 def get_info(request):
     return {
         "remote_ip": request.remote,
@@ -68,8 +191,54 @@ def get_info(request):
     }
 
 
+async def metrics_handler(request: web.Request):
+    """prometheus text of request latency, body, db pool, serial, ipgeo and access log
+
+    values are of the serving process, with prefork a scrape is answered by one worker
+    """
+    lines = metrics.render_histogram(
+        "http_request_duration_seconds",
+        "handler latency by route, method and status",
+        [({"route": r, "method": m, "status": s}, h) for (r, m, s), h in list(metrics.requests.items())],
+    )
+    lines += metrics.render_histogram("http_request_body_seconds", "json body read and parse", [({"phase": k}, h) for k, h in metrics.body.items()])
+    lines += metrics.render_histogram("db_pool_acquire_seconds", "wait of serial pool acquire", [({}, serial.acquire_seconds)])
+
+    db = request.app.db
+    if db is not None:
+        pools = []
+        for i, pool in enumerate(db.stats()):
+            name = pool["role"] if i == 0 else f"{pool['role']}-{i}"
+            pools.append(({"pool": name, "state": "used"}, pool["size"] - pool["idle"]))
+            pools.append(({"pool": name, "state": "idle"}, pool["idle"]))
+            pools.append(({"pool": name, "state": "max"}, pool["max"]))
+        lines += metrics.render_values("db_pool_connections", "connections of database pools", "gauge", pools)
+
+    stats = serial.stats()
+    # prepared statement counters are estimates, not exported
+    caches = [({"cache": "sql"}, stats["sql"])]
+    caches += [({"cache": "object", "model": k}, v) for k, v in stats["objects"].items()]
+    caches.append(({"cache": "identity"}, {"evictions": 0, **stats["identity"]}))
+    for k in ("hits", "misses", "evictions"):
+        lines += metrics.render_values(f"serial_cache_{k}_total", f"serial cache {k}", "counter", [(labels, v[k]) for labels, v in caches])
+
+    stats = ipgeo.stats()
+    lines += metrics.render_values("ipgeo_lookups_total", "ip addresses looked up", "counter", [({"api": k}, v) for k, v in stats["lookups"].items()])
+    for k in ("hits", "misses", "evictions"):
+        lines += metrics.render_values(f"ipgeo_cache_{k}_total", f"ipgeo cache {k}", "counter", [({}, stats[k])])
+
+    stats = access_log.stats()
+    lines += metrics.render_values("access_log_records_total", "access records", "counter", [({"state": k}, stats[k]) for k in ("written", "dropped")])
+    lines += metrics.render_values("access_log_pending", "access records in buffer", "gauge", [({}, stats["pending"])])
+
+    lines.append("")
+    return web.Response(body="\n".join(lines).encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
 @web.middleware
 async def middleware_default(request: web.Request, handler):
+    start = time.perf_counter()
+
     # get X-Forwarded-For
     request = request.clone(remote=request.headers.get("X-Forwarded-For", request.remote))
 
@@ -85,38 +254,37 @@ async def middleware_default(request: web.Request, handler):
     # inspect
     request.db = request.app.db
 
-    # parse json
-    data: dict = {}
-    params: dict = {}
+    # json body is read as bytes here, and parsed on the first access of request.data/params
     if request.body_exists and ("application/json" in request.content_type or "text/plain" in request.content_type):
-        content = await request.text()
-        if content:
-            data = json.loads(content)
-            params = data.get("params", {})
-        else:
-            data = {"params": {}}
-            params = {}
-    request.data = data
-    request.params = params
+        read_start = time.perf_counter()
+        request.json_body = await read_body(request)
 
-    # run handler and handle the exception
+        if metrics.enabled:
+            metrics.body["read"].observe(time.perf_counter() - read_start)
+
+    # run handler and handle the exception, objects of serial.GetMethod are loaded once per request
     try:
-        resp = await handler(request)
+        with serial.identity_map():
+            resp = await handler(request)
     except ErrorBasic as exc:
         error(f"global logic error handle:{str(exc)}")
 
-        access(request, exc)
-        resp = web.Response(body=exc.dump(), status=200, content_type="application/json")
+        status = exc.code
+        resp = web.Response(body=exc.dumps(), status=200, content_type="application/json")
     except Exception as exc:
         error(f"global unknown exception:{exc}")
 
-        access(request, exc)
+        status = 500
         resp = web.Response(body=json.dumps({"code": 500, "error": str(exc)}), status=200, content_type="application/json")
     else:
-        access(request)
+        status = resp.code if isinstance(resp, ErrorBasic) else getattr(resp, "status", 200)
 
-    if isinstance(resp, dict):
-        resp = web.Response(body=json.dumps(resp, default=_custom_json_dump), status=200, content_type="application/json")
+    if isinstance(resp, dict) or (Fragment is not None and isinstance(resp, Fragment)):
+        resp = web.Response(body=dumps(resp), status=200, content_type="application/json")
+
+    elif isinstance(resp, (bytes, bytearray)):
+        # pre-encoded json
+        resp = web.Response(body=resp, status=200, content_type="application/json")
 
     elif isinstance(resp, str):
         resp = web.Response(text=resp, status=200)
@@ -125,15 +293,63 @@ async def middleware_default(request: web.Request, handler):
         exc = resp
         resp = web.Response(body=exc.dumps(), status=200, content_type="application/json")
 
+    latency = time.perf_counter() - start
+    access(request, status=status, latency=latency)
+
+    if metrics.enabled:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        metrics.observe_request(route, request.method, status, latency)
+
     return resp
 
 
+def _ipgeo_options(config: configparser.ConfigParser) -> Tuple[int, dict]:
+    """refresh interval and load options of [ipgeo]"""
+    section = config["ipgeo"]
+    options = {
+        "compiled": section.getboolean("compiled", True),
+        "mapped": section.getboolean("mapped", False),
+        "cache_size": section.getint("cache_size", 0),
+    }
+    return section.getint("refresh_interval", 0), options
+
+
+async def _ipgeo_helper(interval: int, options: dict):
+    """prefork helper, download a missing ipgeo database and refresh it once for all workers
+
+    SIGUSR2 the master when the file is replaced, a mapped searcher validates it without building the index
+    """
+    options = {**options, "mapped": True, "cache_size": 0}
+
+    def notify():
+        os.kill(os.getppid(), signal.SIGUSR2)
+
+    if not ipgeo.ready():
+        await ipgeo.load(**options)
+        if ipgeo.ready():
+            notify()
+
+    while interval > 0:
+        await asyncio.sleep(interval)
+
+        try:
+            if await ipgeo.update(**options):
+                notify()
+        except Exception as e:
+            warning(f"refresh ip location database failed:{e}")
+
+
 class Application(web.Application):
-    db: Optional[asyncpg.pool.Pool] = None
+    db: Optional[serial.Cluster] = None
     config: configparser.ConfigParser
+    tasks: List[asyncio.Task]
+    preforked: bool = False
+    stale: bool = False
 
     def __init__(self, routes, **kwargs):
         self.db = None
+        self.tasks = []
 
         self.config = load_config()
 
@@ -145,8 +361,18 @@ class Application(web.Application):
 
         super().__init__(**kwargs)
 
+        self.client_max_size = kwargs["client_max_size"]
         self.middlewares.append(middleware_default)
 
+        # latency histograms and prometheus /metrics
+        section = self.config["http"]
+        if section.getboolean("metrics", False):
+            metrics.enabled = True
+
+            path = section.get("metrics_path", "/metrics")
+            self.router.add_get(path, metrics_handler)
+            info(f"add metrics route {path}")
+
         for route in routes:
             key = route[0]
             if key in ["post", "get", "delete", "put", "option", "head"]:
@@ -169,6 +395,7 @@ class Application(web.Application):
     def start(self):
         self.middlewares.freeze()
         self.on_startup.append(self.setup)
+        self.on_cleanup.append(self.teardown)
 
         config = load_config()
         section = config["http"]
@@ -176,38 +403,126 @@ class Application(web.Application):
         host = section.get("host", "127.0.0.1")
         port = section.getint("port", 8080)
 
+        if section.getboolean("prefork", False):
+            # a local ipgeo database is loaded before fork and shared copy-on-write by workers,
+            # download and refresh run once in the helper process. every worker runs setup for its own loop and database pools
+            self.preforked = True
+            interval, options = _ipgeo_options(config)
+            if os.path.isfile(ipgeo.PATH_DB):
+                try:
+                    asyncio.run(ipgeo.load(download=False, **options))
+                except Exception as e:
+                    warning(f"load ip location database failed:{e}")
+
+            prefork.run(
+                self,
+                host,
+                port,
+                section.getint("workers", 0) or os.cpu_count() or 1,
+                reuse_port=section.getboolean("reuse_port", True),
+                graceful_timeout=section.getfloat("graceful_timeout", 30),
+                helper=lambda: asyncio.run(_ipgeo_helper(interval, options)),
+            )
+            return
+
         web.run_app(self, host=host, port=port, loop=self.loop)
 
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """run on loop instead, e.g. in a forked worker"""
+        self._loop = loop
+        loop.add_signal_handler(signal.SIGUSR1, self.reload)
+
+    def _make_request(self, message, payload, protocol, writer, task, _cls=Request):
+        # lazy json body
+        return super()._make_request(message, payload, protocol, writer, task, _cls)
+
     def reload(self):
         self.config = load_config()
 
+    def refreshed(self):
+        """prefork helper replaced shared data, workers forked from now on load it again"""
+        self.stale = True
+
     @staticmethod
     async def setup(app):
         config = load_config()
+
+        # setup shared http client
+        section = config["http"]
+        await utils.setup_session(
+            limit=section.getint("client_limit", 100),
+            limit_per_host=section.getint("client_limit_per_host", 16),
+            keepalive_timeout=section.getfloat("client_keepalive_timeout", 30),
+            ttl_dns_cache=section.getint("client_dns_cache_ttl", 300),
+        )
+
         section = config["database"]
 
         # setup database connection
         if "postgresql" in section:
-            dsn = section["postgresql"]
+            min_size = section.getint("pool_min_size", 1)
+            options = {
+                "min_size": min_size,
+                "max_size": max(min_size, section.getint("pool_max_size", 10)),
+                "init": conn_init,
+                "statement_cache_size": serial.statement_cache_size,
+                "max_cacheable_statement_size": serial.max_cacheable_statement_size,
+                "max_cached_statement_lifetime": serial.max_cached_statement_lifetime,
+                "command_timeout": section.getfloat("command_timeout", 5.0),
+                "timeout": section.getfloat("connect_timeout", 10.0),
+                "max_inactive_connection_lifetime": section.getfloat("max_inactive_connection_lifetime", 600),
+            }
+            replicas = [i.strip() for i in section.get("postgresql_replicas", "").split(",") if i.strip()]
+
             try:
+                primary = await create_pool(dsn=section["postgresql"], **options)
+
+                # close opened pools when one of them failed
+                pools = await asyncio.gather(*[create_pool(dsn=dsn, **options) for dsn in replicas], return_exceptions=True)
+                errors = [i for i in pools if isinstance(i, BaseException)]
+                if errors:
+                    await asyncio.gather(primary.close(), *[i.close() for i in pools if not isinstance(i, BaseException)])
+                    raise errors[0]
+
+                app.db = serial.Cluster(primary, pools, select=section.get("replica_select", "round_robin"))
 
-                async def conn_init(con):
-                    await con.set_type_codec(
-                        "jsonb",
-                        schema="pg_catalog",
-                        encoder=lambda x: json.dumps(x).decode(),
-                        decoder=lambda x: json.loads(x),
-                    )
-
-                app.db = await create_pool(
-                    dsn=dsn,
-                    min_size=1,
-                    init=conn_init,
-                    command_timeout=5.0,
-                    max_inactive_connection_lifetime=600,
-                )
+                # opt-in, every process opens it for the primary and every replica
+                warmup = section.getint("pool_warmup", 0)
+                if warmup > 0:
+                    await app.db.warmup(warmup)
 
             except ConnectionRefusedError:
                 exception(f"database pool create failed")
 
-        await ipgeo.load()
+        interval, options = _ipgeo_options(config)
+        if app.preforked:
+
+            def reload():
+                app.tasks.append(asyncio.ensure_future(ipgeo.load(download=False, **options)))
+
+            # the helper process downloaded or refreshed the file
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, reload)
+
+            # not loaded by the master, or replaced after it
+            if os.path.isfile(ipgeo.PATH_DB) and (app.stale or not ipgeo.ready()):
+                reload()
+        else:
+            # load in background and start serving at once, ipgeo.find return empty result until ipgeo.ready()
+            app.tasks.append(asyncio.ensure_future(ipgeo.serve(interval, **options)))
+
+    @staticmethod
+    async def teardown(app):
+        # stop background tasks
+        for task in app.tasks:
+            task.cancel()
+
+        if app.tasks:
+            await asyncio.gather(*app.tasks, return_exceptions=True)
+        app.tasks.clear()
+
+        await utils.close_session()
+        access_log.flush()
+
+        if app.db is not None:
+            await app.db.close()
+            app.db = None
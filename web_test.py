@@ -0,0 +1,262 @@
+from . import metrics, web
+from .config import load_config
+from .exception import ErrorBasic, InvalidParams, ObjectNotFound
+from .log import access_log
+from .web import Application, BasicHandler
+import asyncio
+import time
+import unittest
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import orjson as json
+from aiohttp.test_utils import TestClient, TestServer
+from aiohttp.web import json_response
+
+
+class Echo(BasicHandler):
+    async def get(self):
+        return json_response({"params": self.params}, dumps=lambda x: json.dumps(x).decode())
+
+
+async def echo(request):
+    return {"data": request.data, "params": request.params}
+
+
+async def untouched(request):
+    # body is read but never parsed
+    return {"parsed": request._data is not None, "size": len(request.json_body or b"")}
+
+
+async def raw(request):
+    # aiohttp body api after the middleware read it
+    body = await request.read()
+    return {"size": len(body), "same": body == await request.read(), "params": (await request.json())["params"]}
+
+
+async def internals(request):
+    return {"request": type(request) is web.Request, "read_bytes": "_read_bytes" in dir(request)}
+
+
+class TestBody(unittest.TestCase):
+    def run_client(self, test):
+        async def run():
+            app = Application([("/view", Echo), ("post", "/echo", echo), ("post", "/untouched", untouched), ("post", "/raw", raw), ("get", "/internals", internals)])
+            try:
+                async with TestClient(TestServer(app)) as client:
+                    return await test(client)
+            finally:
+                access_log.flush()
+
+        return asyncio.run(run())
+
+    def test_lazy(self):
+        async def test(client):
+            resp = await client.post("/echo", data=json.dumps({"params": {"a": 1}, "b": 2}), headers={"Content-Type": "application/json"})
+            self.assertEqual(await resp.json(), {"data": {"params": {"a": 1}, "b": 2}, "params": {"a": 1}})
+
+            # get with body, text/plain
+            resp = await client.get("/view", data=b'{"params": {"q": "x"}}', headers={"Content-Type": "text/plain"})
+            self.assertEqual(await resp.json(), {"params": {"q": "x"}})
+
+            resp = await client.post("/echo", data=b"", headers={"Content-Type": "application/json"})
+            self.assertEqual(await resp.json(), {"data": {}, "params": {}})
+
+            resp = await client.post("/echo", data=b"<xml/>", headers={"Content-Type": "application/xml"})
+            self.assertEqual(await resp.json(), {"data": {}, "params": {}})
+
+            resp = await client.post("/echo", data=b"{broken", headers={"Content-Type": "application/json"})
+            self.assertEqual((await resp.json())["code"], 400)
+
+            resp = await client.post("/untouched", data=b"{broken", headers={"Content-Type": "application/json"})
+            self.assertEqual(await resp.json(), {"parsed": False, "size": 7})
+
+        self.run_client(test)
+
+    def test_aiohttp_internals(self):
+        # lazy body relies on private aiohttp api, Application._make_request(_cls=) and Request._read_bytes
+        async def test(client):
+            resp = await client.get("/internals")
+            self.assertEqual(await resp.json(), {"request": True, "read_bytes": True}, "aiohttp private api changed, check web.Request")
+
+        self.run_client(test)
+
+    def test_stream(self):
+        size = web.json_stream_size
+        web.json_stream_size = 1024
+        try:
+
+            async def test(client):
+                params = {"items": list(range(10000))}
+                resp = await client.post("/echo", data=json.dumps({"params": params}), headers={"Content-Type": "application/json"})
+                self.assertEqual((await resp.json())["params"], params)
+
+                # streamed body is still returned by request.read/json
+                body = json.dumps({"params": params})
+                resp = await client.post("/raw", data=body, headers={"Content-Type": "application/json"})
+                self.assertEqual(await resp.json(), {"size": len(body), "same": True, "params": params})
+
+                resp = await client.post("/raw", data=b'{"params": 1}', headers={"Content-Type": "application/json"})
+                self.assertEqual(await resp.json(), {"size": 13, "same": True, "params": 1})
+
+            self.run_client(test)
+        finally:
+            web.json_stream_size = size
+
+
+@dataclass
+class Row:
+    id: str
+    ts_created: datetime
+    count: int
+
+
+class Located:
+    def __init__(self, ip):
+        self.ip = ip
+
+    def dump(self):
+        return {"ip": self.ip}
+
+
+class NotFoundWithKey(ObjectNotFound):
+    def __init__(self, key):
+        super().__init__()
+        self.key = key
+
+    def dump(self):
+        return {**super().dump(), "key": self.key}
+
+
+async def response(request):
+    kind = request.params.get("kind")
+    if kind == "bytes":
+        return b'{"cached": true}'
+    elif kind == "error":
+        raise ObjectNotFound()
+    elif kind == "error_msg":
+        raise InvalidParams(msg="bad name")
+    elif kind == "error_key":
+        raise NotFoundWithKey("k")
+
+    ts = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    return {"row": Row("a", ts, 1), "located": Located("1.1.1.1"), "price": Decimal("1.5"), "counts": {1: "one"}}
+
+
+class TestResponse(unittest.TestCase):
+    def run_client(self, test):
+        async def run():
+            app = Application([("post", "/response", response)])
+            try:
+                async with TestClient(TestServer(app)) as client:
+                    return await test(client)
+            finally:
+                access_log.flush()
+
+        return asyncio.run(run())
+
+    def test_response(self):
+        async def test(client):
+            async def post(kind):
+                resp = await client.post("/response", data=json.dumps({"params": {"kind": kind}}), headers={"Content-Type": "application/json"})
+                self.assertEqual(resp.content_type, "application/json")
+                return await resp.json()
+
+            self.assertEqual(
+                await post("dict"),
+                {
+                    "row": {"id": "a", "ts_created": "2024-01-02T03:04:05+00:00", "count": 1},
+                    "located": {"ip": "1.1.1.1"},
+                    "price": 1.5,
+                    "counts": {"1": "one"},
+                },
+            )
+            self.assertEqual(await post("bytes"), {"cached": True})
+            self.assertEqual(await post("error"), {"code": 404, "error": "object not found"})
+            self.assertEqual(await post("error_msg"), {"code": 400, "error": "bad name"})
+            self.assertEqual(await post("error_key"), {"code": 404, "error": "object not found", "key": "k"})
+
+        self.run_client(test)
+
+    def test_error_payload(self):
+        self.assertIs(ObjectNotFound().dumps(), ObjectNotFound.payload)
+        self.assertIs(ErrorBasic().dumps(), ErrorBasic.payload)
+        self.assertEqual(json.loads(InvalidParams.payload), {"code": 400, "error": "invalid params"})
+        self.assertEqual(json.loads(InvalidParams(msg="x").dumps()), {"code": 400, "error": "x"})
+        self.assertEqual(json.loads(NotFoundWithKey("k").dumps())["key"], "k")
+
+    @unittest.skipIf(web.Fragment is None, "orjson.Fragment needs orjson>=3.9")
+    def test_fragment(self):
+        cached = web.Fragment(b'{"k":[1,2]}')
+        self.assertEqual(json.loads(web.dumps({"a": cached, "b": [cached]})), {"a": {"k": [1, 2]}, "b": [{"k": [1, 2]}]})
+
+    def test_benchmark(self):
+        ts = datetime.now(timezone.utc)
+        count = 2000
+        rounds = 20
+
+        def rows():
+            return {"items": [{"id": f"item-{i}", "ts_created": ts, "count": i, "info": {"tags": ["a", "b"], "score": i / 3}} for i in range(count)], "total": count}
+
+        resp = rows()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            plain = json.dumps(resp, default=web._custom_json_dump)
+        plain_rate = count * rounds / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            native = web.dumps(resp)
+        native_rate = count * rounds / (time.perf_counter() - start)
+
+        # cached sub-documents: info encoded once
+        if web.Fragment is not None:
+            for i in resp["items"]:
+                i["info"] = web.Fragment(json.dumps(i["info"]))
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                fragment = web.dumps(resp)
+            fragment_rate = count * rounds / (time.perf_counter() - start)
+
+            self.assertEqual(json.loads(fragment), json.loads(native))
+            print(f"\nlist response: default hook {plain_rate:.0f} rows/s, native {native_rate:.0f} rows/s, fragments {fragment_rate:.0f} rows/s")
+        else:
+            print(f"\nlist response: default hook {plain_rate:.0f} rows/s, native {native_rate:.0f} rows/s")
+
+        self.assertEqual(json.loads(plain), json.loads(native))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics(self):
+        section = load_config()["http"]
+        section["metrics"] = "true"
+
+        async def run():
+            app = Application([("post", "/echo/{name}", echo)])
+            try:
+                async with TestClient(TestServer(app)) as client:
+                    for name in ("a", "b"):
+                        await client.post(f"/echo/{name}", data=b'{"params": {}}', headers={"Content-Type": "application/json"})
+                    await client.get("/missing")
+
+                    resp = await client.get("/metrics")
+                    self.assertEqual(resp.headers["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+                    return await resp.text()
+            finally:
+                access_log.flush()
+
+        try:
+            text = asyncio.run(run())
+        finally:
+            section["metrics"] = "false"
+            metrics.enabled = False
+
+        self.assertIn('http_request_duration_seconds_count{route="/echo/{name}",method="POST",status="200"} 2', text)
+        # not found is answered as code 500 by middleware_default
+        self.assertIn('http_request_duration_seconds_count{route="unmatched",method="GET",status="500"} 1', text)
+        self.assertIn('http_request_body_seconds_count{phase="read"}', text)
+        self.assertIn("ipgeo_lookups_total{api=\"find\"}", text)
+        self.assertIn("serial_cache_hits_total{cache=\"sql\"}", text)
+        self.assertIn("access_log_records_total{state=\"dropped\"} 0", text)